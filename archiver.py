@@ -1,15 +1,26 @@
 import argparse
+import contextlib
 import datetime
-import fnmatch
+import io
 import logging
 import os
-import shutil
-import tarfile
+import re
+import sys
 import time
 
 import typing as T
 
 import config
+import locking
+from formats import COPY_BUFSIZE, DATED_ARCHIVE
+import profiling
+from tree import PathTree
+from policy import Share, SharePolicy, configured_shares
+
+# tarfile, shutil and friends are only imported where they're used, so that quick runs such as
+# `plan` don't pay for them
+if T.TYPE_CHECKING:
+    import tarfile
 
 
 def all_entries(directory: str) -> T.List[str]:
@@ -23,23 +34,215 @@ def all_entries(directory: str) -> T.List[str]:
     return all_paths
 
 
-def archive_unit(directory: str, archive_location: str, ttl: int, weaponised: bool, parent_archive: str, library_loc: str, ignore_format: str) -> None:
-    """Archive directories as a whole, where everything in the directory is last modified more than the ttl (days)
-    Files shouldn't be stored in the locations of the directories (except .archiveignore), so they'll be archived immediately
+@contextlib.contextmanager
+def _mapper(policy: SharePolicy) -> T.Iterator[T.Callable[..., T.Iterator[T.Any]]]:
+    """A map function spread over the policy's worker threads"""
+
+    if policy.workers == 1:
+        yield map
+        return
+
+    import concurrent.futures
+
+    with concurrent.futures.ThreadPoolExecutor(policy.workers) as pool:
+        yield pool.map
+
+
+def _has_magic(pattern: str) -> bool:
+    return any(c in pattern for c in "*?[")
+
+
+def _sha256(path: str) -> str:
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(COPY_BUFSIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _fingerprint(path: str) -> T.Tuple[int, int]:
+    """The size and modified time of a file, to tell whether it has changed since it was hashed"""
+
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def _hash_unchanged(path: str) -> T.Optional[T.Tuple[str, T.Tuple[int, int]]]:
+    """Hash a file along with its fingerprint, or None if it changed while being hashed"""
+
+    try:
+        before = _fingerprint(path)
+        digest = _sha256(path)
+        if _fingerprint(path) != before:
+            return None
+    except OSError:
+        return None
+    return digest, before
+
+
+def _duplicates(paths: T.List[str], policy: SharePolicy) -> T.Dict[str, T.Tuple[str, T.Tuple[int, int]]]:
+    """Hash the regular files which share their size with another, as only they can be duplicates
+
+    Each hash is kept with the file's fingerprint, as files can change between being hashed and being
+    added, and those which changed while being hashed are left out.
+    """
+
+    by_size: T.Dict[int, T.List[str]] = {}
+    for path in paths:
+        if os.path.isfile(path) and not os.path.islink(path):
+            by_size.setdefault(os.stat(path).st_size, []).append(path)
+
+    candidates = [path for size, group in by_size.items()
+                  if size != 0 and len(group) > 1 for path in group]
+    with _mapper(policy) as mapper:
+        return {path: hashed for path, hashed in zip(candidates, mapper(_hash_unchanged, candidates))
+                if hashed is not None}
+
+
+def _record_checksum(tarball: "_Tarball") -> None:
+    """Write the .sha256 alongside a finished archive, in the format `sha256sum --check` reads
+
+    This marks the archive as complete, so is done once its fofn is written too.
+    """
+
+    with open(f"{tarball.name}.sha256", "w") as f:
+        f.write(f"{tarball.checksum}  {os.path.basename(tarball.name)}\n")
+
+
+class _HashedFile(io.BufferedWriter):
+    """A file being written, hashed on its way to disk"""
+
+    def __init__(self, name: str) -> None:
+        import hashlib
+
+        super().__init__(io.FileIO(name, "wb"), COPY_BUFSIZE)
+        self.digest = hashlib.sha256()
+
+    def write(self, data: T.Any) -> int:
+        self.digest.update(data)
+        return super().write(data)
+
+
+class _Tarball:
+    """A tarball being written, whose checksum is worked out as it's written rather than by reading it back
+
+    Used as a context manager it gives the TarFile, and closes the tarball afterwards.
+    """
+
+    def __init__(self, name: str, policy: SharePolicy) -> None:
+        import tarfile
+
+        self.name = name
+        self.checksum: T.Optional[str] = None
+        self._file = _HashedFile(name)
+        try:
+            if policy.codec == "xz":
+                self.tar = tarfile.open(fileobj=self._file, mode="w:xz", preset=policy.level)
+            else:
+                self.tar = tarfile.open(fileobj=self._file, mode=f"w:{policy.codec}", compresslevel=policy.level)
+        except BaseException:
+            self._file.close()
+            raise
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        try:
+            self.tar.close()
+        finally:
+            self._file.close()
+        self.checksum = self._file.digest.hexdigest()
+
+    def __enter__(self) -> "tarfile.TarFile":
+        return self.tar
+
+    def __exit__(self, *args: T.Any) -> None:
+        self.close()
+
+
+def _add(tar: "tarfile.TarFile", name: str, policy: SharePolicy, arcname: T.Optional[str] = None) -> None:
+    before = tar.offset
+    with profiling.stage("tar"):
+        tar.add(name, arcname=arcname)
+    if policy.throttle:
+        time.sleep((tar.offset - before) / policy.throttle)
+
+
+def _write_volumes(to_archive: T.List[str], fn: str, policy: SharePolicy) -> T.List[_Tarball]:
+    """Write files to `fn`.tar.<codec>, continuing in `fn`.2.tar.<codec> and so on once the volume size is reached
+
+    :return: - The volumes written, to record their checksums once the fofn is written
+    """
+
+    import tarfile
+
+    duplicates = _duplicates(to_archive, policy) if policy.dedup else {}
+    stored: T.Dict[str, str] = {}
+    volume = 1
+    name = f"{fn}.{policy.extension}"
+
+    volumes = [_Tarball(name, policy)]
+    try:
+        logging.debug(f"creating tarball {name}")
+        for f in to_archive:
+            tar = volumes[-1].tar
+            if policy.volume_size and tar.offset >= policy.volume_size:
+                volumes[-1].close()
+                volume += 1
+                name = f"{fn}.{volume}.{policy.extension}"
+                logging.debug(f"creating tarball {name}")
+                volumes.append(_Tarball(name, policy))
+                tar = volumes[-1].tar
+                stored = {}
+
+            # A file is only linked to, or stored as a link, while it's unchanged since being hashed, so
+            # that a link never stands in for different content
+            hashed = duplicates.get(f)
+            if hashed is not None and _fingerprint(f) != hashed[1]:
+                logging.debug(f"{f} has changed since it was hashed, so adding it in full")
+                hashed = None
+            digest = hashed[0] if hashed is not None else None
+
+            if digest is not None and digest in stored:
+                logging.debug(f"adding {f} to tarball as a link to {stored[digest]}")
+                tarinfo = tar.gettarinfo(f)
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = stored[digest]
+                tarinfo.size = 0
+                with profiling.stage("tar"):
+                    tar.addfile(tarinfo)
+                continue
+
+            logging.debug(f"adding {f} to tarball")
+            _add(tar, f, policy)
+            if hashed is not None and _fingerprint(f) == hashed[1]:
+                stored[hashed[0]] = f.lstrip("/")
+    finally:
+        volumes[-1].close()
+    return volumes
+
+
+def plan_unit(directory: str, ttl: int, ignore_format: str) -> T.Tuple[T.List[str], T.List[str]]:
+    """Find what archive_unit would archive
 
     :param directory: - The parent directory
-    :param archive_location: - The path within the main archive location for these files to be archived
     :param ttl: - Time to live (days) - Last Modified Time
-    :param weaponised: - Whether the original files will be deleted afterwards
-    :param parent_archive: - The main archive location
-    :param library_loc: - The main location for fofn (file of file names) files
     :param ignore_format: - The format files will be in if they are to be processed as ignore files
+    :return: - The subdirectories to archive as a whole, and the stray files to archive, as full paths
     """
 
+    import fnmatch
+
     logging.info(f"analysing {directory}")
 
-    all_files = os.walk(directory)
-    _, subdirectories, files = next(all_files)
+    try:
+        with profiling.stage("walk"):
+            _, subdirectories, files = next(os.walk(directory))
+    except StopIteration:
+        logging.warning(f"{directory} doesn't exist")
+        return [], []
 
     ignore_files: T.List[str] = [
         os.path.join(directory, f) for f in files if os.path.join(directory, f).endswith(ignore_format)]
@@ -52,70 +255,110 @@ def archive_unit(directory: str, archive_location: str, ttl: int, weaponised: bo
                     os.path.dirname(ignorefile), entry.strip("\n")))
     logging.debug(f"all ignore paths: {paths_to_ignore}")
 
-    for subdirectory in subdirectories:
-        _mtime = datetime.datetime.fromtimestamp(
-            os.stat(os.path.join(directory, subdirectory)).st_mtime)
+    to_archive: T.List[str] = []
+    with profiling.stage("ignore"):
+        # Patterns without wildcards can only match one path, so look them up rather than trying them all
+        literals: T.Set[str] = {pattern for pattern in paths_to_ignore if not _has_magic(pattern)}
+        patterns: T.List[str] = [pattern for pattern in paths_to_ignore if _has_magic(pattern)]
+
+        for subdirectory in subdirectories:
+            _mtime = datetime.datetime.fromtimestamp(
+                os.stat(os.path.join(directory, subdirectory)).st_mtime)
+
+            if (datetime.datetime.now() - _mtime).days < ttl \
+                    or os.path.join(directory, subdirectory) in literals \
+                    or any([fnmatch.fnmatch(os.path.join(directory, subdirectory), pattern) for pattern in patterns]):
+                continue
+
+            logging.debug(f"planning to archive {os.path.join(directory, subdirectory)}")
+            to_archive.append(os.path.join(directory, subdirectory))
+
+    stray_files = [os.path.join(directory, f) for f in files
+                   if not os.path.join(directory, f).endswith(ignore_format)]
+
+    return to_archive, stray_files
+
+
+def archive_unit(directory: str, archive_location: str, ttl: int, weaponised: bool, parent_archive: str, library_loc: str, ignore_format: str, policy: SharePolicy = SharePolicy()) -> None:
+    """Archive directories as a whole, where everything in the directory is last modified more than the ttl (days)
+    Files shouldn't be stored in the locations of the directories (except .archiveignore), so they'll be archived immediately
+
+    :param directory: - The parent directory
+    :param archive_location: - The path within the main archive location for these files to be archived
+    :param ttl: - Time to live (days) - Last Modified Time
+    :param weaponised: - Whether the original files will be deleted afterwards
+    :param parent_archive: - The main archive location
+    :param library_loc: - The main location for fofn (file of file names) files
+    :param ignore_format: - The format files will be in if they are to be processed as ignore files
+    :param policy: - How the files are archived
+    """
+
+    import shutil
 
-        if (datetime.datetime.now() - _mtime).days < ttl \
-                or any([fnmatch.fnmatch(os.path.join(directory, subdirectory), pattern) for pattern in paths_to_ignore]):
-            continue
+    subdirectories, files = plan_unit(directory, ttl, ignore_format)
 
+    for path in subdirectories:
+        subdirectory = os.path.basename(path)
         fn = f"{archive_location}/{subdirectory.replace(' ', '')}.{datetime.datetime.now().strftime('%Y%m%d')}"
 
-        with tarfile.open(f"{parent_archive}/{fn}.tar.gz", "w:gz") as tar:
-            logging.debug(f"creating tarball {parent_archive}/{fn}.tar.gz")
-            tar.add(os.path.join(directory, subdirectory),
-                    arcname=subdirectory)
+        tarball = _Tarball(f"{parent_archive}/{fn}.{policy.extension}", policy)
+        with tarball as tar:
+            logging.debug(f"creating tarball {parent_archive}/{fn}.{policy.extension}")
+            _add(tar, path, policy, arcname=subdirectory)
 
+        with profiling.stage("walk"):
+            entries = all_entries(path)
         with open(f"{library_loc}/{fn}.fofn", "w") as fofn:
             logging.info(f"writing {library_loc}/{fn}.fofn")
-            fofn.write("\n".join(all_entries(
-                os.path.join(directory, subdirectory))))
+            fofn.write("\n".join(entries))
+        _record_checksum(tarball)
 
         if weaponised:
             logging.warning("deleting directory that was archived")
-            shutil.rmtree(os.path.join(directory, subdirectory))
+            with profiling.stage("delete"):
+                shutil.rmtree(path)
 
     if len(files) != 0:
         logging.info(f"found files where they shouldn't be: {directory}")
         fn = f"{archive_location}/{datetime.datetime.now().strftime('%Y%m%d')}"
-        with tarfile.open(f"{parent_archive}/{fn}.tar.gz", "w:gz") as tar:
+        tarball = _Tarball(f"{parent_archive}/{fn}.{policy.extension}", policy)
+        with tarball as tar:
             for f in files:
-                if not os.path.join(directory, f).endswith(ignore_format):
-                    logging.debug(f"adding {f} to tarball")
-                    tar.add(os.path.join(directory, f))
+                logging.debug(f"adding {f} to tarball")
+                _add(tar, f, policy)
 
         with open(f"{library_loc}/{fn}.fofn", "w") as fofn:
             logging.info(f"writing {library_loc}/{fn}.fofn")
-            fofn.write(
-                "\n".join([os.path.join(directory, f) for f in files if not os.path.join(directory, f).endswith(ignore_format)]))
+            fofn.write("\n".join(files))
+        _record_checksum(tarball)
 
         if weaponised:
             logging.warning("deleting files that were archived")
-            for f in files:
-                if not os.path.join(directory, f).endswith(ignore_format):
-                    os.remove(os.path.join(directory, f))
+            with profiling.stage("delete"):
+                for f in files:
+                    os.remove(f)
 
 
-def archive_full(directory: str, archive_location: str, ttl: int, weaponised: bool, parent_archive: str, library_loc: str, ignore_format: str) -> None:
-    """Archive all files in a directory and its subdirectories when it's last accessed more than the ttl (days)
+def plan_full(directory: str, ttl: int, ignore_format: str, policy: SharePolicy = SharePolicy()) -> T.List[str]:
+    """Find what archive_full would archive
 
     :param directory: - The parent directory
-    :param archive_location: - The path within the main archive location for these files to be archived
     :param ttl: - Time to live (days) - Last Modified Time
-    :param weaponised: - Whether the original files will be deleted afterwards
-    :param parent_archive: - The main archive location
-    :param library_loc: - The main location for fofn (file of file names) files
     :param ignore_format: - The format files will be in if they are to be processed as ignore files
+    :param policy: - How the files are archived
+    :return: - The files and directories to archive, as full paths
     """
 
+    import fnmatch
+
     logging.info(f"analysing {directory}")
 
-    all_items = all_entries(directory)
+    with profiling.stage("walk"), _mapper(policy) as mapper:
+        tree = PathTree.scan(directory, mapper)
     to_archive: T.List[str] = []
 
     ignore_files: T.List[str] = [
-        f for f in all_items if f.endswith(ignore_format)]
+        path for _, path in tree.paths() if path.endswith(ignore_format)]
     paths_to_ignore: T.List[str] = []
     for ignorefile in ignore_files:
         logging.debug(f"found ignorefile {ignorefile}")
@@ -128,68 +371,428 @@ def archive_full(directory: str, archive_location: str, ttl: int, weaponised: bo
                 ))
     logging.debug(f"all ignore paths: {paths_to_ignore}")
 
-    for item in all_items:
-        _mtime = datetime.datetime.fromtimestamp(os.stat(item).st_mtime)
-        if (datetime.datetime.now() - _mtime).days >= ttl \
-                and not any([fnmatch.fnmatch(item, pattern) for pattern in paths_to_ignore]) \
-                and not item.endswith(ignore_format):
-            logging.debug(f"planning to archive {item}")
-            to_archive.append(item)
+    with profiling.stage("ignore"):
+        # Patterns without wildcards match a single path, or everything below one when they end in
+        # /*, so they can be looked up in the tree rather than matched against every path
+        ignored = bytearray(len(tree))
+        patterns: T.List[str] = []
+        for pattern in paths_to_ignore:
+            subtree = pattern.endswith("/*") and not _has_magic(pattern[:-2])
+            if not subtree and _has_magic(pattern):
+                patterns.append(pattern)
+                continue
+
+            node = tree.find(pattern[:-2] if subtree else pattern)
+            if node is None or (node == -1 and not subtree):
+                continue
+            for ignored_node in (tree.descendants(node) if subtree else [node]):
+                ignored[ignored_node] = 1
+
+        # A pattern with wildcards can only match below the directory named by the part before its
+        # first wildcard, so it's only tried against the paths in that directory
+        anchored: T.Dict[int, T.List[T.Callable[[str], T.Any]]] = {}
+        for pattern in patterns:
+            literal = pattern[:min(pattern.find(c) for c in "*?[" if c in pattern)]
+            anchor = literal[:literal.rfind("/")]
+            if "/" not in literal or os.path.join(directory, "").startswith(anchor + "/"):
+                node = -1
+            else:
+                node = tree.find(anchor)
+                if node is None:
+                    continue
+            anchored.setdefault(node, []).append(re.compile(fnmatch.translate(pattern)).match)
+
+        applicable: T.Dict[int, T.List[T.Callable[[str], T.Any]]] = {-1: anchored.get(-1, [])}
+        for node, item in tree.paths():
+            matchers = applicable[tree.parents[node]]
+            if tree.is_dir[node]:
+                applicable[node] = matchers + anchored[node] if node in anchored else matchers
+
+            _mtime = datetime.datetime.fromtimestamp(tree.mtimes[node])
+            if (datetime.datetime.now() - _mtime).days >= ttl \
+                    and not ignored[node] \
+                    and not any([match(item) for match in matchers]) \
+                    and not item.endswith(ignore_format):
+                logging.debug(f"planning to archive {item}")
+                to_archive.append(item)
+
+    return to_archive
+
+
+def archive_full(directory: str, archive_location: str, ttl: int, weaponised: bool, parent_archive: str, library_loc: str, ignore_format: str, policy: SharePolicy = SharePolicy()) -> None:
+    """Archive all files in a directory and its subdirectories when it's last accessed more than the ttl (days)
+
+    :param directory: - The parent directory
+    :param archive_location: - The path within the main archive location for these files to be archived
+    :param ttl: - Time to live (days) - Last Modified Time
+    :param weaponised: - Whether the original files will be deleted afterwards
+    :param parent_archive: - The main archive location
+    :param library_loc: - The main location for fofn (file of file names) files
+    :param ignore_format: - The format files will be in if they are to be processed as ignore files
+    :param policy: - How the files are archived
+    """
+
+    to_archive = plan_full(directory, ttl, ignore_format, policy)
 
     if len(to_archive) != 0:
         fn = f"{archive_location}/{datetime.datetime.now().strftime('%Y%m%d')}"
-        with tarfile.open(f"{parent_archive}/{fn}.tar.gz", "w:gz") as tar:
-            for f in to_archive:
-                logging.debug(f"adding {f} to tarball")
-                tar.add(f)
+        volumes = _write_volumes(to_archive, f"{parent_archive}/{fn}", policy)
 
         with open(f"{library_loc}/{fn}.fofn", "w") as fofn:
             logging.info(f"writing {library_loc}/{fn}.fofn")
             fofn.write("\n".join(to_archive))
+        for tarball in volumes:
+            _record_checksum(tarball)
 
         if weaponised:
+            import shutil
+
             logging.warning("deleting files that were archived")
-            for f in to_archive:
-                try:
+            with profiling.stage("delete"):
+                for f in to_archive:
                     try:
-                        os.remove(f)
-                    except IsADirectoryError:
-                        shutil.rmtree(f)
-                except FileNotFoundError:
-                    pass
+                        try:
+                            os.remove(f)
+                        except IsADirectoryError:
+                            shutil.rmtree(f)
+                    except FileNotFoundError:
+                        pass
 
 
-def main(weaponised: bool = False) -> None:
-    logging.info("starting the archive process")
+def _date(value: str) -> str:
+    """Check a date is given as YYYYMMDD
+
+    :raises ValueError: - If it isn't a real date in that form
+    """
+
+    try:
+        if re.fullmatch(r"\d{8}", value) is None:
+            raise ValueError
+        datetime.datetime.strptime(value, "%Y%m%d")
+    except ValueError:
+        raise ValueError(f"{value!r} isn't a date in the form YYYYMMDD") from None
+    return value
+
+
+def compact(archive_location: str, start: str, end: str, parent_archive: str, library_loc: str, extension: str = "tar.gz") -> T.Optional[str]:
+    """Merge the dated archives in a date range into a single indexed archive with a merged fofn
+
+    The source tarballs (including any extra volumes) are concatenated byte for byte, so nothing is
+    recompressed. The result is a multi-stream archive, named YYYYMMDD-YYYYMMDD.multi.tar.<codec> to
+    set it apart, which needs `tar --ignore-zeros` (or `ignore_zeros=True` in tarfile, as extract()
+    uses) to be read past the first source. A `.idx` file is written alongside it, listing the offset,
+    length, name and members of each source, so a single source can be read back without scanning the
+    whole archive.
+
+    :param archive_location: - The path within the main archive location to compact
+    :param start: - The first date to include (YYYYMMDD)
+    :param end: - The last date to include (YYYYMMDD)
+    :param parent_archive: - The main archive location
+    :param library_loc: - The main location for fofn (file of file names) files
+    :param extension: - The extension of the archives to compact, for the codec they were written with
+    :return: - The path of the compacted archive, or None if there was nothing to compact
+    :raises ValueError: - If start or end isn't a date in the form YYYYMMDD
+    """
 
-    for directory, (archive_location, ttl) in config.ARCHIVE_DIRS.items():
-        archive_full(directory, archive_location, ttl, weaponised,
-                     config.ARCHIVE_LOC, config.LIBRARY_LOC, config.ARCHIVE_IGNORE_FORMAT)
+    import hashlib
+    import tarfile
+
+    _date(start)
+    _date(end)
+
+    logging.info(f"compacting {archive_location} from {start} to {end}")
+
+    try:
+        candidates = os.listdir(os.path.join(parent_archive, archive_location))
+    except FileNotFoundError:
+        return None
+
+    sources: T.List[T.Tuple[str, int, str]] = sorted(
+        (m.group(1), int(m.group(2) or 1), m.group(0)) for m in (DATED_ARCHIVE.match(c) for c in candidates)
+        if m is not None and m.group(3) == extension and start <= m.group(1) <= end)
+    dates: T.List[str] = sorted({date for date, _, _ in sources})
+
+    if len(sources) < 2:
+        logging.info(f"nothing to compact in {archive_location}")
+        return None
+
+    fn = f"{archive_location}/{dates[0]}-{dates[-1]}.multi"
+    archive_path = f"{parent_archive}/{fn}.{extension}"
+    index_path = f"{parent_archive}/{fn}.idx"
+    fofn_path = f"{library_loc}/{fn}.fofn"
+
+    offset = 0
+    index: T.List[str] = []
+    digest = hashlib.sha256()
+    with open(f"{archive_path}.tmp", "wb") as out, open(f"{fofn_path}.tmp", "w") as fofn:
+        for date, _, name in sources:
+            logging.debug(f"adding {parent_archive}/{archive_location}/{name} to compacted archive")
+            with open(f"{parent_archive}/{archive_location}/{name}", "rb") as src:
+                for block in iter(lambda: src.read(COPY_BUFSIZE), b""):
+                    digest.update(block)
+                    out.write(block)
+                length = out.tell() - offset
+            with tarfile.open(f"{parent_archive}/{archive_location}/{name}") as tar:
+                members = tar.getnames()
+            # Each source is followed by its members, indented by a tab
+            index.extend([f"{offset}\t{length}\t{name}", *[f"\t{member}" for member in members]])
+            offset += length
+
+        for date in dates:
+            try:
+                with open(f"{library_loc}/{archive_location}/{date}.fofn") as src_fofn:
+                    entries = src_fofn.read()
+            except FileNotFoundError:
+                logging.warning(f"no fofn for {parent_archive}/{archive_location}/{date}.{extension}")
+                continue
+            if entries:
+                if fofn.tell() != 0:
+                    fofn.write("\n")
+                fofn.write(entries)
+
+        out.flush()
+        os.fsync(out.fileno())
+        fofn.flush()
+        os.fsync(fofn.fileno())
+
+    with open(f"{index_path}.tmp", "w") as idx:
+        idx.write("\n".join(index))
+        idx.flush()
+        os.fsync(idx.fileno())
+
+    with open(f"{archive_path}.sha256.tmp", "w") as checksum:
+        checksum.write(f"{digest.hexdigest()}  {os.path.basename(archive_path)}\n")
+
+    # Only swap the new files in once they're all complete, and only remove the originals once
+    # everything is in place, so an interrupted run leaves duplicates rather than losing anything
+    os.replace(f"{index_path}.tmp", index_path)
+    os.replace(f"{fofn_path}.tmp", fofn_path)
+    os.replace(f"{archive_path}.sha256.tmp", f"{archive_path}.sha256")
+    os.replace(f"{archive_path}.tmp", archive_path)
+    logging.info(f"wrote {archive_path}")
+    logging.warning(f"{archive_path} is a multi-stream archive: extract it with `archiver.py extract` "
+                    f"or `tar --ignore-zeros`, as plain tar stops after {sources[0][2]}")
+
+    for _, _, name in sources:
+        logging.debug(f"removing compacted archive {parent_archive}/{archive_location}/{name}")
+        os.remove(f"{parent_archive}/{archive_location}/{name}")
+        try:
+            os.remove(f"{parent_archive}/{archive_location}/{name}.sha256")
+        except FileNotFoundError:
+            pass
+
+    for date in dates:
+        try:
+            os.remove(f"{library_loc}/{archive_location}/{date}.fofn")
+        except FileNotFoundError:
+            pass
+
+    return archive_path
+
+
+def read_index(index_path: str) -> T.List[T.Tuple[int, int, str, T.List[str]]]:
+    """Read the index of a compacted archive
+
+    :param index_path: - The path of the `.idx` file
+    :return: - (offset, length, source name, members) for each source archive, in order
+    """
+
+    index: T.List[T.Tuple[int, int, str, T.List[str]]] = []
+    with open(index_path) as f:
+        for entry in f:
+            entry = entry.strip("\n")
+            if entry.startswith("\t"):
+                index[-1][3].append(entry[1:])
+            else:
+                offset, length, name = entry.split("\t", 2)
+                index.append((int(offset), int(length), name, []))
+
+    return index
+
+
+def extract(archive_path: str, destination: str, members: T.Optional[T.List[str]] = None) -> T.List[str]:
+    """Extract an archive, reading on through every source of a compacted one
+
+    :param archive_path: - The archive to extract
+    :param destination: - The directory to extract into
+    :param members: - Only extract these members, reading just the sources that hold them if the
+                      archive has an index
+    :return: - The members extracted
+    """
+
+    import tarfile
+
+    index_path = f"{re.sub(r'[.]tar[.][a-z0-9]+$', '', archive_path)}.idx"
+    if members is None or not os.path.exists(index_path):
+        wanted = None if members is None else set(members)
+        extracted: T.List[str] = []
+        with tarfile.open(archive_path, ignore_zeros=True) as tar:
+            for member in tar:
+                if wanted is None or member.name in wanted:
+                    tar.extract(member, destination)
+                    extracted.append(member.name)
+        return extracted
+
+    extracted = []
+    with open(archive_path, "rb") as f:
+        for offset, _, name, source_members in read_index(index_path):
+            wanted = set(members) & set(source_members)
+            if not wanted:
+                continue
+            logging.debug(f"extracting {len(wanted)} members from {name} in {archive_path}")
+            # Each source ends with its own end of archive marker, so without ignore_zeros reading
+            # stops at the end of it
+            f.seek(offset)
+            with tarfile.open(fileobj=f) as tar:
+                for member in tar:
+                    if member.name in wanted:
+                        tar.extract(member, destination)
+                        extracted.append(member.name)
+
+    return extracted
+
+
+def main(weaponised: bool = False, shares: T.Optional[T.List[Share]] = None, profile: T.Optional[str] = None) -> None:
+    logging.info("starting the archive process")
 
-    for directory, (archive_location, ttl) in config.ARCHIVE_UNITS.items():
-        archive_unit(directory, archive_location, ttl, weaponised,
-                     config.ARCHIVE_LOC, config.LIBRARY_LOC, config.ARCHIVE_IGNORE_FORMAT)
+    if shares is None:
+        shares = configured_shares()
+
+    # Shares another run (on this host or another) is busy with, or has already finished today, are
+    # skipped, so several runs can split the shares between them. A weaponised run also covers a
+    # plain one, but not the other way round
+    task = "weaponised" if weaponised else "archive"
+    for share in [*[share for share in shares if not share.unit], *[share for share in shares if share.unit]]:
+        lock = locking.ShareLock(config.LOCK_DIR, share.name, config.LOCK_LEASE, config.LOCK_SETTLE)
+        with lock as acquired:
+            if not acquired:
+                logging.info(f"skipping {share.directory} as another run is archiving it")
+                continue
+            if lock.finished(task) or lock.finished("weaponised"):
+                logging.info(f"skipping {share.directory} as it has already been archived today")
+                continue
+
+            archive = archive_unit if share.unit else archive_full
+            with profiling.profile(profile, share.name, config.PROFILE_TOP):
+                archive(share.directory, share.location, share.ttl, weaponised,
+                        config.ARCHIVE_LOC, config.LIBRARY_LOC, config.ARCHIVE_IGNORE_FORMAT, share.policy)
+            lock.finish(task)
 
     logging.info("finished the archive process")
 
 
-if __name__ == "__main__":
+def compact_all(start: str, end: str, shares: T.Optional[T.List[Share]] = None) -> None:
+    logging.info("starting the compaction process")
+
+    if shares is None:
+        shares = configured_shares()
+
+    for share in shares:
+        with locking.ShareLock(config.LOCK_DIR, share.name, config.LOCK_LEASE, config.LOCK_SETTLE) as acquired:
+            if not acquired:
+                logging.info(f"skipping {share.location} as another run is using it")
+                continue
+            compact(share.location, start, end, config.ARCHIVE_LOC,
+                    config.LIBRARY_LOC, share.policy.extension)
+
+    logging.info("finished the compaction process")
+
+
+def plan_all(shares: T.Optional[T.List[Share]] = None) -> None:
+    """Print everything the archiver would archive, without touching anything"""
+
+    if shares is None:
+        shares = configured_shares()
+
+    for share in [share for share in shares if not share.unit]:
+        for path in plan_full(share.directory, share.ttl, config.ARCHIVE_IGNORE_FORMAT, share.policy):
+            print(path)
+
+    for share in [share for share in shares if share.unit]:
+        subdirectories, files = plan_unit(
+            share.directory, share.ttl, config.ARCHIVE_IGNORE_FORMAT)
+        for path in [*subdirectories, *files]:
+            print(path)
+
+
+def cli(argv: T.Optional[T.List[str]] = None) -> int:
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--weaponised", help="run archiver deleting files once archived", action="store_true")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--profile", metavar="PREFIX", help="profile each share, writing PREFIX.<share>.pstats")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser(
+        "archive", help="archive old files (the default)")
+    subparsers.add_parser(
+        "plan", help="list what would be archived, without archiving anything")
+    compact_parser = subparsers.add_parser(
+        "compact", help="merge the dated archives in a date range into one indexed archive")
+    compact_parser.add_argument("start", help="first date to compact (YYYYMMDD)")
+    compact_parser.add_argument("end", help="last date to compact (YYYYMMDD)")
+    extract_parser = subparsers.add_parser(
+        "extract", help="extract an archive, including every source of a compacted one")
+    extract_parser.add_argument("archive", help="the archive to extract")
+    extract_parser.add_argument("destination", help="the directory to extract into")
+    extract_parser.add_argument("members", nargs="*",
+                                help="only extract these members (default: everything)")
+    scrub_parser = subparsers.add_parser(
+        "scrub", help="verify the archives that are due against their fofns and checksums")
+    scrub_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                              help="how many archives to verify at once (default: one per core)")
+    scrub_parser.add_argument("--limit", type=int,
+                              help="most archives to verify in this run")
+    args = parser.parse_args(argv)
+    if args.profile is not None and args.command not in (None, "archive"):
+        parser.error(f"--profile only applies to archiving, not {args.command}")
 
     logging.basicConfig(level=config.LOGGING_LEVEL,
                         format="%(asctime)s - %(levelname)s - %(message)s")
 
-    if not args.weaponised:
+    # extract and scrub work from what's in the archive location, so still work while the share
+    # definitions are broken, and don't pay for loading them
+    if args.command == "extract":
+        extract(args.archive, args.destination, args.members or None)
+        return 0
+
+    if args.command == "scrub":
+        import scrub
+
+        return 0 if scrub.scrub(config.ARCHIVE_LOC, config.LIBRARY_LOC, config.SCRUB_STATE, config.SCRUB_INTERVAL,
+                                args.workers, config.SCRUB_RATE, args.limit, config.SCRUB_SAVE_INTERVAL) else 1
+
+    try:
+        shares = configured_shares()
+    except (OSError, ValueError, ImportError) as e:
+        parser.error(f"invalid share definitions: {e}")
+
+    if args.command == "plan":
+        plan_all(shares)
+
+    elif args.command == "compact":
+        try:
+            _date(args.start)
+            _date(args.end)
+        except ValueError as e:
+            parser.error(str(e))
+        logging.warning("THIS WILL DELETE THE ARCHIVES ONCE COMPACTED!")
+        time.sleep(config.SAFETY_DELAY)
+        compact_all(args.start, args.end, shares)
+
+
+    elif not args.weaponised:
         logging.info(
             "Running the archiver without deleting fils once archived.")
-        time.sleep(5)
-        main()
+        main(shares=shares, profile=args.profile)
 
     else:
         logging.info("Running the archiver.")
         logging.warning("THIS WILL DELETE THE FILES ONCE ARCHIVED!")
-        time.sleep(5)
-        main(weaponised=True)
+        time.sleep(config.SAFETY_DELAY)
+        main(weaponised=True, shares=shares, profile=args.profile)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -1,4 +1,12 @@
 #!/bin/bash
 
 SCRIPT_DIR="/home/archiver/vashta-nerada"
-python3 $SCRIPT_DIR/archiver.py --weaponised > /filestore/Archive/logs/"$(date '+%Y-%m-%d')".log 2>&1
+LOG="/filestore/Archive/logs/$(date '+%Y-%m-%d')"
+
+# Set ARCHIVER_PROFILE to write a profile of each share next to the log
+PROFILE_ARGS=()
+if [ -n "$ARCHIVER_PROFILE" ]; then
+    PROFILE_ARGS=(--profile "$LOG")
+fi
+
+python3 $SCRIPT_DIR/archiver.py --weaponised "${PROFILE_ARGS[@]}" > "$LOG".log 2>&1
@@ -24,3 +24,29 @@ ARCHIVE_UNITS: T.Dict[str, T.Tuple[str, int]] = {
 }
 
 LOGGING_LEVEL: int = logging.INFO
+
+# TOML or YAML file of share definitions and their policies, used instead of ARCHIVE_DIRS and
+# ARCHIVE_UNITS when set (see policy.load_shares)
+SHARES_FILE: T.Optional[str] = None
+
+# Seconds to wait before a run which deletes files, giving a chance to cancel it
+SAFETY_DELAY: int = 5
+
+# How many of the slowest functions to log for each share when running with --profile
+PROFILE_TOP: int = 15
+
+# Where each share's lock, lease and done files are kept, which must be visible to every host running the archiver
+LOCK_DIR: str = "/filestore/Archive/locks"
+# Seconds before the lock of a run which has stopped renewing it is treated as abandoned
+LOCK_LEASE: int = 600
+# Seconds to wait after taking a lease before checking another host didn't take it at the same time
+LOCK_SETTLE: int = 2
+
+# Where the scrub remembers which archives it has verified, and when
+SCRUB_STATE: str = "/filestore/Archive/scrub.json"
+# Days before an archive is verified again
+SCRUB_INTERVAL: int = 90
+# Maximum bytes per second the scrub reads (0 for no limit)
+SCRUB_RATE: int = 0
+# Seconds between the scrub saving what it has verified, as well as when it stops
+SCRUB_SAVE_INTERVAL: int = 30
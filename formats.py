@@ -0,0 +1,12 @@
+import re
+
+import typing as T
+
+# Shared by archiver and scrub, which imports it from here rather than from archiver, so that running
+# `archiver.py scrub` doesn't load archiver a second time under its module name
+
+# A full archive, or an extra volume of one. Volume numbers are kept short of 8 digits, so that a unit
+# archive of a subdirectory named like a date (such as 20190101.20261019.tar.gz) isn't taken for one
+DATED_ARCHIVE: T.Pattern[str] = re.compile(r"^(\d{8})(?:\.(\d{1,7}))?\.(tar\.[a-z0-9]+)$")
+# Bytes read or written at a time when copying or hashing archives
+COPY_BUFSIZE: int = 1024 * 1024
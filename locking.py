@@ -0,0 +1,170 @@
+import datetime
+import errno
+import fcntl
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+import typing as T
+
+
+class ShareLock:
+    """An exclusive lock on a share, so that archiver runs on any number of hosts can share the work
+
+    The lock is a POSIX (fcntl) lock on `<name>.lock`, in a directory every host can see, which NFS
+    passes on to the server. As not every shared mount does so, the holder also writes a lease to
+    `<name>.lease` and renews it while the lock is held. A lease which hasn't been renewed within
+    `lease` seconds is treated as abandoned, so the hosts' clocks should agree to well within that.
+
+    The lease is replaced whole rather than rewritten, so it's never seen half written, and is kept
+    apart from the lock file as replacing that would leave the fcntl lock on the old file. Two hosts
+    which both find no live lease (when fcntl locks aren't passed on) can still both write one, so
+    after writing its lease the taker waits `settle` seconds and checks it's still there, and only the
+    host whose lease was written last goes on.
+
+    fcntl locks belong to a process rather than a file descriptor, and closing any descriptor for the
+    lock file drops them, so one process shouldn't hold two ShareLocks for the same share, and nothing
+    else should open the lock file; different processes and hosts are fine.
+    """
+
+    def __init__(self, lock_dir: str, name: str, lease: float, settle: float = 0.0) -> None:
+        """
+        :param lock_dir: - The directory lock files are kept in
+        :param name: - The name of the share
+        :param lease: - How long (seconds) a lease lasts without being renewed
+        :param settle: - How long (seconds) to wait after taking a lease before checking it's still ours
+        """
+
+        self.path = os.path.join(lock_dir, f"{name}.lock")
+        self.lease_path = os.path.join(lock_dir, f"{name}.lease")
+        self.done_path = os.path.join(lock_dir, f"{name}.done")
+        self.lease = lease
+        self.settle = settle
+        self.holder = f"{socket.gethostname()} {os.getpid()} {uuid.uuid4().hex}"
+        self._fd: T.Optional[int] = None
+        self._stop = threading.Event()
+        self._renewer: T.Optional[threading.Thread] = None
+
+    def _read(self, path: str) -> str:
+        try:
+            with open(path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    def _replace(self, path: str, contents: str) -> None:
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w") as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _read_lease(self) -> T.Optional[T.Tuple[str, float]]:
+        try:
+            holder, timestamp = self._read(self.lease_path).strip().rsplit(" ", 1)
+            return holder, float(timestamp)
+        except ValueError:
+            return None
+
+    def _renew(self) -> None:
+        while not self._stop.wait(self.lease / 3):
+            lease = self._read_lease()
+            if lease is None or lease[0] != self.holder:
+                logging.error(f"lost the lease on {self.lease_path} to {lease[0] if lease else 'nobody'}")
+                return
+            logging.debug(f"renewing lease on {self.lease_path}")
+            self._replace(self.lease_path, f"{self.holder} {time.time()}\n")
+
+    def held_by(self) -> T.Optional[str]:
+        """Who holds the lease, or None if nobody has a live one
+
+        Only the lease file is read, so this is safe to call while holding the lock.
+        """
+
+        lease = self._read_lease()
+        if lease is None or time.time() - lease[1] >= self.lease:
+            return None
+        return lease[0]
+
+    def acquire(self) -> bool:
+        """Take the lock if nobody else has it
+
+        :return: - Whether the lock was taken
+        """
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            os.close(fd)
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            raise
+
+        holder = self.held_by()
+        if holder is None:
+            self._replace(self.lease_path, f"{self.holder} {time.time()}\n")
+            if self.settle:
+                time.sleep(self.settle)
+                holder = self.held_by()
+
+        if holder is not None and holder != self.holder:
+            # The fcntl lock didn't reach us, but another host has (or has just taken) the lease
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+            os.close(fd)
+            return False
+
+        self._fd = fd
+        self._stop.clear()
+        self._renewer = threading.Thread(target=self._renew, daemon=True)
+        self._renewer.start()
+        return True
+
+    def release(self) -> None:
+        if self._fd is None:
+            return
+
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+            self._renewer = None
+
+        lease = self._read_lease()
+        if lease is not None and lease[0] == self.holder:
+            try:
+                os.remove(self.lease_path)
+            except FileNotFoundError:
+                pass
+        fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def finished(self, task: str) -> bool:
+        """Whether a task has already been finished on the share today
+
+        :param task: - The name of the task
+        """
+
+        today = datetime.date.today().strftime("%Y%m%d")
+        return f"{task} {today}" in self._read(self.done_path).splitlines()
+
+    def finish(self, task: str) -> None:
+        """Record that a task has been finished on the share today, which should be done while holding the lock
+
+        :param task: - The name of the task
+        """
+
+        done = [entry for entry in self._read(self.done_path).splitlines() if entry.split(" ", 1)[0] != task]
+        self._replace(self.done_path, "".join(
+            [f"{entry}\n" for entry in [*done, f"{task} {datetime.date.today().strftime('%Y%m%d')}"]]))
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *args: T.Any) -> None:
+        self.release()
@@ -0,0 +1,194 @@
+import dataclasses
+import os
+
+import typing as T
+
+import config
+
+CODECS: T.Tuple[str, ...] = ("gz", "bz2", "xz")
+# The compression levels each codec accepts, as bz2 has no level 0
+LEVELS: T.Dict[str, range] = {"gz": range(0, 10), "bz2": range(1, 10), "xz": range(0, 10)}
+SCAN_STRATEGIES: T.Tuple[str, ...] = ("full",)
+MODES: T.Tuple[str, ...] = ("full", "unit")
+
+
+@dataclasses.dataclass(frozen=True)
+class SharePolicy:
+    """How a share is archived
+
+    :param codec: - Compression used for the tarballs (gz, bz2 or xz)
+    :param level: - Compression level (0-9, or 1-9 for bz2)
+    :param workers: - Threads used to stat and hash files while planning
+    :param volume_size: - Start a new tarball once this many bytes have been added (0 for no limit, full archives only)
+    :param throttle: - Maximum bytes per second read into tarballs (0 for no limit)
+    :param dedup: - Store identical files once per tarball, as hard links (full archives only)
+    :param scan: - How the share is scanned for files to archive
+    """
+
+    codec: str = "gz"
+    level: int = 9
+    workers: int = 1
+    volume_size: int = 0
+    throttle: int = 0
+    dedup: bool = False
+    scan: str = "full"
+
+    def __post_init__(self) -> None:
+        if self.codec not in CODECS:
+            raise ValueError(f"codec must be one of {', '.join(CODECS)}, not {self.codec!r}")
+        levels = LEVELS[self.codec]
+        if isinstance(self.level, bool) or not isinstance(self.level, int) or self.level not in levels:
+            raise ValueError(
+                f"level must be an integer from {levels[0]} to {levels[-1]} for {self.codec}, not {self.level!r}")
+        if isinstance(self.workers, bool) or not isinstance(self.workers, int) or self.workers < 1:
+            raise ValueError(f"workers must be a positive integer, not {self.workers!r}")
+        if isinstance(self.volume_size, bool) or not isinstance(self.volume_size, int) or self.volume_size < 0:
+            raise ValueError(f"volume_size must be a non-negative integer, not {self.volume_size!r}")
+        if isinstance(self.throttle, bool) or not isinstance(self.throttle, int) or self.throttle < 0:
+            raise ValueError(f"throttle must be a non-negative integer, not {self.throttle!r}")
+        if not isinstance(self.dedup, bool):
+            raise ValueError(f"dedup must be true or false, not {self.dedup!r}")
+        if self.scan not in SCAN_STRATEGIES:
+            raise ValueError(f"scan must be one of {', '.join(SCAN_STRATEGIES)}, not {self.scan!r}")
+
+    @property
+    def extension(self) -> str:
+        return f"tar.{self.codec}"
+
+
+@dataclasses.dataclass(frozen=True)
+class Share:
+    """A directory on the filestore to be archived
+
+    :param directory: - The directory to archive
+    :param location: - The path within the main archive location for its files to be archived
+    :param ttl: - Time to live (days) - Last Modified Time
+    :param unit: - Whether subdirectories are archived as a whole (archive_unit) rather than file by file (archive_full)
+    :param policy: - How the share is archived
+    """
+
+    directory: str
+    location: str
+    ttl: int
+    unit: bool = False
+    policy: SharePolicy = SharePolicy()
+
+    @property
+    def name(self) -> str:
+        """A name for the share which is safe to use in file names"""
+        return self.location.replace("/", "-").replace(" ", "")
+
+
+def _policy(values: T.Mapping[str, T.Any], base: SharePolicy, where: str) -> SharePolicy:
+    fields = {f.name for f in dataclasses.fields(SharePolicy)}
+    unknown = set(values) - fields
+    if unknown:
+        raise ValueError(f"{where}: unknown policy settings {', '.join(sorted(unknown))}")
+
+    try:
+        return dataclasses.replace(base, **values)
+    except ValueError as e:
+        raise ValueError(f"{where}: {e}") from None
+
+
+def _read(path: str) -> T.Dict[str, T.Any]:
+    if path.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib  # type: ignore
+            except ImportError:
+                raise ImportError(
+                    f"reading {path} needs Python 3.11 or the tomli package") from None
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError(f"reading {path} needs the PyYAML package") from None
+        with open(path) as f:
+            try:
+                return yaml.safe_load(f) or {}
+            except yaml.YAMLError as e:
+                raise ValueError(f"{path}: {e}") from None
+
+    raise ValueError(f"{path}: share definitions must be a .toml, .yaml or .yml file")
+
+
+def load_shares(path: str) -> T.List[Share]:
+    """Load and validate share definitions from a TOML or YAML file
+
+    The file has an optional `defaults` table of policy settings and a `share` list, where each share
+    has a `directory`, `location`, `ttl`, optional `mode` (full or unit) and any policy settings to
+    override the defaults with.
+
+    :param path: - The path of the share definitions
+    :return: - The shares, in the order they're defined
+    """
+
+    data = _read(path)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: expected a table of settings")
+
+    unknown = set(data) - {"defaults", "share"}
+    if unknown:
+        raise ValueError(f"{path}: unknown sections {', '.join(sorted(unknown))}")
+
+    if not isinstance(data.get("defaults", {}), dict):
+        raise ValueError(f"{path} defaults: expected a table of policy settings")
+    defaults = _policy(data.get("defaults", {}), SharePolicy(), f"{path} defaults")
+
+    if not isinstance(data.get("share", []), list):
+        raise ValueError(f"{path} share: expected a list of shares")
+
+    shares: T.List[Share] = []
+    # Shares can't share a directory, an archive location, or a name (which their lock files are named by)
+    seen: T.Set[T.Tuple[str, str]] = set()
+    for i, entry in enumerate(data.get("share", [])):
+        where = f"{path} share {i + 1}"
+        if not isinstance(entry, dict):
+            raise ValueError(f"{where}: expected a table of settings, not {entry!r}")
+        entry = dict(entry)
+
+        try:
+            directory = entry.pop("directory")
+            location = entry.pop("location")
+            ttl = entry.pop("ttl")
+        except KeyError as e:
+            raise ValueError(f"{where}: missing {e.args[0]}") from None
+        mode = entry.pop("mode", "full")
+
+        if not isinstance(directory, str) or not os.path.isabs(directory):
+            raise ValueError(f"{where}: directory must be an absolute path, not {directory!r}")
+        if not isinstance(location, str) or location == "" or os.path.isabs(location):
+            raise ValueError(f"{where}: location must be a relative path, not {location!r}")
+        if isinstance(ttl, bool) or not isinstance(ttl, int):
+            raise ValueError(f"{where}: ttl must be an integer, not {ttl!r}")
+        if mode not in MODES:
+            raise ValueError(f"{where}: mode must be one of {', '.join(MODES)}, not {mode!r}")
+
+        share = Share(directory, location, ttl, mode == "unit", _policy(entry, defaults, f"{where} ({directory})"))
+        for kind, value in [("directory", share.directory), ("location", share.location), ("name", share.name)]:
+            if (kind, value) in seen:
+                raise ValueError(f"{where}: {kind} {value} is used by more than one share")
+            seen.add((kind, value))
+        shares.append(share)
+
+    return shares
+
+
+def configured_shares() -> T.List[Share]:
+    """The shares to archive, from config.SHARES_FILE if it's set, otherwise config.ARCHIVE_DIRS and config.ARCHIVE_UNITS"""
+
+    if config.SHARES_FILE is not None:
+        return load_shares(config.SHARES_FILE)
+
+    return [
+        *[Share(directory, archive_location, ttl)
+          for directory, (archive_location, ttl) in config.ARCHIVE_DIRS.items()],
+        *[Share(directory, archive_location, ttl, unit=True)
+          for directory, (archive_location, ttl) in config.ARCHIVE_UNITS.items()]
+    ]
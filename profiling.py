@@ -0,0 +1,78 @@
+import contextlib
+import logging
+import time
+
+import typing as T
+
+
+class Stages:
+    """Wall time spent in each stage of an archiver run"""
+
+    def __init__(self) -> None:
+        self.totals: T.Dict[str, float] = {}
+        self.calls: T.Dict[str, int] = {}
+
+    def add(self, name: str, elapsed: float) -> None:
+        self.totals[name] = self.totals.get(name, 0.0) + elapsed
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def summary(self) -> str:
+        return "\n".join(f"{name}: {total:.3f}s over {self.calls[name]} calls"
+                         for name, total in sorted(self.totals.items(), key=lambda item: -item[1]))
+
+
+_active: T.Optional[Stages] = None
+
+
+@contextlib.contextmanager
+def stage(name: str) -> T.Iterator[None]:
+    """Time a stage of the current profiled run, doing nothing when no run is being profiled"""
+
+    if _active is None:
+        yield
+        return
+
+    stages = _active
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages.add(name, time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def profile(prefix: T.Optional[str], name: str, top: int) -> T.Iterator[None]:
+    """Profile a share, writing `prefix`.`name`.pstats and logging the slowest stages and functions
+
+    :param prefix: - Where to write the profile, or None to not profile
+    :param name: - The name of the share being profiled
+    :param top: - How many functions to list in the log
+    """
+
+    global _active
+
+    if prefix is None:
+        yield
+        return
+
+    import cProfile
+    import io
+    import pstats
+
+    stages = Stages()
+    profiler = cProfile.Profile()
+    _active = stages
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _active = None
+
+        profiler.dump_stats(f"{prefix}.{name}.pstats")
+
+        hotspots = io.StringIO()
+        pstats.Stats(profiler, stream=hotspots).sort_stats(
+            "cumulative").print_stats(top)
+        logging.info(f"profile of {name} written to {prefix}.{name}.pstats\n"
+                     f"{stages.summary()}\n{hotspots.getvalue().strip()}")
@@ -0,0 +1,288 @@
+import json
+import logging
+import os
+import re
+import time
+
+import typing as T
+
+from formats import COPY_BUFSIZE, DATED_ARCHIVE
+
+ARCHIVE: T.Pattern[str] = re.compile(r"^(.*)\.(tar\.[a-z0-9]+)$")
+# A subdirectory archived by archive_unit, as opposed to the dated archives of loose files
+UNIT_ARCHIVE: T.Pattern[str] = re.compile(r"^(.+)\.(\d{8})\.(tar\.[a-z0-9]+)$")
+# Archives without a recorded checksum modified more recently than this (seconds) may still be being
+# written, as the checksum is only recorded once an archive is finished
+UNFINISHED_AGE: int = 24 * 60 * 60
+
+# An archive, or the volumes of one, along with the fofn listing what's in it
+Group = T.Tuple[T.List[str], str]
+
+
+def find_archives(parent_archive: str, library_loc: str) -> T.List[Group]:
+    """Find every archive below the main archive location, grouping volumes that share a fofn
+
+    :param parent_archive: - The main archive location
+    :param library_loc: - The main location for fofn (file of file names) files
+    """
+
+    groups: T.Dict[str, T.List[str]] = {}
+    for directory, _, files in os.walk(parent_archive):
+        for name in files:
+            m = ARCHIVE.match(name)
+            if m is None:
+                continue
+
+            dated = DATED_ARCHIVE.match(name)
+            stem = dated.group(1) if dated is not None else m.group(1)
+            location = os.path.relpath(directory, parent_archive)
+            groups.setdefault(os.path.join(library_loc, location, f"{stem}.fofn"), []).append(
+                os.path.join(directory, name))
+
+    return [(sorted(archives, key=_volume), fofn) for fofn, archives in sorted(groups.items())]
+
+
+def _volume(archive: str) -> int:
+    dated = DATED_ARCHIVE.match(os.path.basename(archive))
+    return int(dated.group(2) or 1) if dated is not None else 1
+
+
+def _finished(archive: str, now: float) -> bool:
+    return os.path.exists(f"{archive}.sha256") or now - os.stat(archive).st_mtime >= UNFINISHED_AGE
+
+
+def _unit_members(entries: T.List[str], members: T.Set[str]) -> T.Optional[T.Dict[str, str]]:
+    """The member each fofn entry of a unit archive should be, or None if that can't be worked out
+
+    A unit archive holds a subdirectory under its own name, and its fofn lists everything below it
+    (including every directory), so the subdirectory is the parent of whichever entry is above all the
+    others, or of all of them if none is.
+    """
+
+    if not entries:
+        return {}
+
+    subdirectory = os.path.commonpath(entries)
+    if subdirectory in set(entries):
+        subdirectory = os.path.dirname(subdirectory)
+    arcname = os.path.basename(subdirectory)
+    if {member.split("/", 1)[0] for member in members} != {arcname}:
+        return None
+
+    return {entry: f"{arcname}{entry[len(subdirectory):]}" for entry in entries}
+
+
+def verify(archives: T.List[str], fofn: str) -> T.Optional[T.List[str]]:
+    """Check archives can be read in full, match any recorded checksums, and hold everything in their fofn
+
+    :param archives: - The archive, or all the volumes of it
+    :param fofn: - The fofn listing what was archived
+    :return: - The problems found, or None if the archives have gone (such as by being compacted)
+    """
+
+    import hashlib
+    import lzma
+    import tarfile
+    import zlib
+
+    problems: T.List[str] = []
+    members: T.Set[str] = set()
+
+    try:
+        for archive in archives:
+            # Anything which can't be read, other than archives which have gone, is a problem with
+            # this archive rather than a reason to stop the scrub
+            try:
+                with open(f"{archive}.sha256") as f:
+                    recorded = f.read().split(" ", 1)[0]
+            except FileNotFoundError:
+                recorded = None
+            except (OSError, ValueError) as e:
+                problems.append(f"{archive}.sha256 can't be read: {e}")
+                recorded = None
+
+            if recorded is not None:
+                digest = hashlib.sha256()
+                try:
+                    with open(archive, "rb") as f:
+                        for block in iter(lambda: f.read(COPY_BUFSIZE), b""):
+                            digest.update(block)
+                except FileNotFoundError:
+                    raise
+                except OSError as e:
+                    problems.append(f"{archive} can't be read: {e}")
+                else:
+                    if digest.hexdigest() != recorded:
+                        problems.append(f"{archive} doesn't match its recorded checksum")
+
+            # Reading every member through to the end checks the compression's own checksums.
+            # ignore_zeros reads on past the end of each of the archives a compacted one is made of
+            try:
+                with tarfile.open(archive, ignore_zeros=True) as tar:
+                    for member in tar:
+                        members.add(member.name)
+                        if member.isfile():
+                            f = tar.extractfile(member)
+                            assert f is not None
+                            while f.read(COPY_BUFSIZE):
+                                pass
+            except FileNotFoundError:
+                raise
+            except (tarfile.TarError, OSError, EOFError, lzma.LZMAError, zlib.error) as e:
+                problems.append(f"{archive} can't be read: {e}")
+
+        try:
+            with open(fofn) as f:
+                entries = [entry.strip("\n") for entry in f if entry.strip("\n")]
+        except FileNotFoundError:
+            problems.append(f"{fofn} is missing")
+            entries = []
+        except (OSError, ValueError) as e:
+            problems.append(f"{fofn} can't be read: {e}")
+            entries = []
+    except FileNotFoundError:
+        return None
+
+    # Unit archives of a subdirectory store it under its own name, and everything else stores
+    # absolute paths without the leading /
+    name = os.path.basename(archives[0])
+    if UNIT_ARCHIVE.match(name) is not None and DATED_ARCHIVE.match(name) is None:
+        expected = _unit_members(entries, members)
+        if expected is None:
+            problems.append(f"the members of {archives[0]} don't match the entries in {fofn}")
+            return problems
+    else:
+        expected = {entry: entry.lstrip("/") for entry in entries}
+
+    for entry in entries:
+        if expected[entry] not in members:
+            problems.append(f"{entry} is in {fofn} but not in {', '.join(archives)}")
+
+    return problems
+
+
+def _load_state(state_path: str) -> T.Dict[str, T.Dict[str, T.Any]]:
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_state(state_path: str, state: T.Dict[str, T.Dict[str, T.Any]]) -> None:
+    with open(f"{state_path}.tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{state_path}.tmp", state_path)
+
+
+def _signature(archives: T.List[str]) -> T.List[T.List[float]]:
+    signature: T.List[T.List[float]] = []
+    for archive in archives:
+        st = os.stat(archive)
+        signature.append([st.st_size, st.st_mtime])
+    return signature
+
+
+def scrub(parent_archive: str, library_loc: str, state_path: str, interval: int, workers: int, rate: int, limit: T.Optional[int] = None, save_interval: float = 30) -> bool:
+    """Verify the archives that are due, oldest verification first, spread across processes
+
+    What has been verified, and when, is saved in the state file every `save_interval` seconds and when
+    the scrub stops, so an interrupted scrub carries on where it left off. Archives are checked again once `interval` days
+    have passed, or straight away if they've changed or failed last time. Archives which may still be
+    being written (see UNFINISHED_AGE) are left for a later run.
+
+    :param parent_archive: - The main archive location
+    :param library_loc: - The main location for fofn (file of file names) files
+    :param state_path: - Where to remember what has been verified
+    :param interval: - Days before an archive is verified again
+    :param workers: - How many archives to verify at once
+    :param rate: - Maximum bytes per second to read (0 for no limit)
+    :param limit: - Most archives to verify in this run
+    :param save_interval: - Seconds between saving the state file
+    :return: - Whether everything verified was fine
+    """
+
+    import concurrent.futures
+
+    logging.info("starting the scrub")
+
+    state = _load_state(state_path)
+    now = time.time()
+
+    groups = find_archives(parent_archive, library_loc)
+    for archive in set(state) - {archives[0] for archives, _ in groups}:
+        del state[archive]
+
+    due: T.List[T.Tuple[float, Group, T.List[T.List[float]]]] = []
+    for archives, fofn in groups:
+        try:
+            signature = _signature(archives)
+            if not all([_finished(archive, now) for archive in archives]):
+                logging.info(f"skipping {archives[0]} as it may still be being written")
+                continue
+        except FileNotFoundError:
+            continue
+
+        previous = state.get(archives[0])
+        if previous is not None and previous["ok"] and previous["signature"] == signature \
+                and now - previous["verified"] < interval * 24 * 60 * 60:
+            continue
+        due.append((previous["verified"] if previous is not None else 0.0, (archives, fofn), signature))
+
+    due.sort(key=lambda item: item[0])
+    if limit is not None:
+        due = due[:limit]
+    logging.info(f"{len(due)} archives due to be verified")
+
+    healthy = True
+    start = time.monotonic()
+    saved = start
+    read = 0
+    try:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            pending: T.Dict[concurrent.futures.Future, T.Tuple[Group, T.List[T.List[float]]]] = {}
+            queue = iter(due)
+
+            while True:
+                for _, group, signature in queue:
+                    # Hold back until the bytes handed out so far fit within the rate limit
+                    if rate:
+                        time.sleep(max(0.0, read / rate - (time.monotonic() - start)))
+                    read += int(sum(size for size, _ in signature))
+                    pending[pool.submit(verify, *group)] = (group, signature)
+                    if len(pending) >= workers:
+                        break
+
+                if not pending:
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    (archives, fofn), signature = pending.pop(future)
+                    problems = future.result()
+
+                    if problems is None:
+                        logging.info(f"{archives[0]} has gone, skipping it")
+                        state.pop(archives[0], None)
+                    else:
+                        for problem in problems:
+                            logging.error(problem)
+                        if problems:
+                            healthy = False
+                        else:
+                            logging.debug(f"verified {', '.join(archives)}")
+                        state[archives[0]] = {"verified": time.time(),
+                                              "ok": not problems, "signature": signature}
+
+                    if time.monotonic() - saved >= save_interval:
+                        _save_state(state_path, state)
+                        saved = time.monotonic()
+    finally:
+        # Saved however the scrub stops, including being interrupted
+        _save_state(state_path, state)
+
+    logging.info("finished the scrub")
+    return healthy
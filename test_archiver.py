@@ -1,11 +1,28 @@
 import unittest
+import unittest.mock
 import archiver
+import config
+import locking
+import policy
+import profiling
+import pstats
+import scrub
+from tree import PathTree
+import io
+import json
 import os
 import shutil
+import subprocess
+import sys
+import time
 import typing as T
 import datetime
+import importlib.util
 import tarfile
 
+HAS_TOML = any([importlib.util.find_spec(name) is not None for name in ["tomllib", "tomli"]])
+HAS_YAML = importlib.util.find_spec("yaml") is not None
+
 
 class TestArchiver(unittest.TestCase):
     def setUp(self) -> None:
@@ -604,5 +621,716 @@ class TestUnitArchiverWeaponised(TestUnitArchiver):
             f"/tmp/archive/{item}.{datetime.datetime.now().strftime('%Y%m%d')}.tar.gz") for item in ["new", "mixed", "ignore"]]))
 
 
+class TestCompact(TestArchiver):
+    def setUp(self) -> None:
+        super().setUp()
+
+        os.mkdir("/tmp/archive/documents")
+        for date in ["20200101", "20200102", "20200103", "20200201"]:
+            os.mkdir(f"/tmp/directory/{date}")
+            with open(f"/tmp/directory/{date}/file", "w") as f:
+                f.write(date)
+            with tarfile.open(f"/tmp/archive/documents/{date}.tar.gz", "w:gz") as tar:
+                tar.add(f"/tmp/directory/{date}/file")
+            with open(f"/tmp/archive/documents/{date}.fofn", "w") as f:
+                f.write(f"/tmp/directory/{date}/file")
+
+        # Unit archives, the second of a subdirectory named like a date
+        for name in ["old.20200102.tar.gz", "20200101.20200102.tar.gz"]:
+            with open(f"/tmp/archive/documents/{name}", "w"):
+                pass
+
+        self.compacted = archiver.compact(
+            "documents", "20200101", "20200131", "/tmp/archive", "/tmp/archive")
+
+    def test_compacted_archive_named_after_range(self):
+        self.assertEqual(self.compacted,
+                         "/tmp/archive/documents/20200101-20200103.multi.tar.gz")
+
+    def test_sources_in_range_removed(self):
+        self.assertTrue(all([not os.path.exists(f"/tmp/archive/documents/{date}.{ext}")
+                        for date in ["20200101", "20200102", "20200103"] for ext in ["tar.gz", "fofn"]]))
+
+    def test_other_archives_untouched(self):
+        self.assertTrue(all([os.path.exists(item) for item in [
+            "/tmp/archive/documents/20200201.tar.gz",
+            "/tmp/archive/documents/20200201.fofn",
+            "/tmp/archive/documents/old.20200102.tar.gz",
+            "/tmp/archive/documents/20200101.20200102.tar.gz"
+        ]]))
+
+    def test_no_temporary_files_left(self):
+        self.assertFalse(any([item.endswith(".tmp")
+                         for item in os.listdir("/tmp/archive/documents")]))
+
+    def test_merged_fofn(self):
+        with open("/tmp/archive/documents/20200101-20200103.multi.fofn") as f:
+            fofn = [entry.strip("\n") for entry in f]
+        self.assertEqual(fofn, [f"/tmp/directory/{date}/file"
+                         for date in ["20200101", "20200102", "20200103"]])
+
+    def test_all_members_in_compacted_archive(self):
+        with tarfile.open(self.compacted, ignore_zeros=True) as tar:
+            tar.extractall("/tmp/extract")
+        self.assertTrue(all([os.path.exists(f"/tmp/extract/tmp/directory/{date}/file")
+                        for date in ["20200101", "20200102", "20200103"]]))
+
+    def test_index_locates_each_source(self):
+        index = archiver.read_index(
+            "/tmp/archive/documents/20200101-20200103.multi.idx")
+        self.assertEqual([name for _, _, name, _ in index], [
+                         "20200101.tar.gz", "20200102.tar.gz", "20200103.tar.gz"])
+        self.assertEqual([members for _, _, _, members in index], [
+                         [f"tmp/directory/{date}/file"] for date in ["20200101", "20200102", "20200103"]])
+
+        with open(self.compacted, "rb") as f:
+            for offset, length, name, _ in index:
+                f.seek(offset)
+                with tarfile.open(fileobj=io.BytesIO(f.read(length))) as tar:
+                    member = tar.extractfile(
+                        f"tmp/directory/{name[:8]}/file")
+                    self.assertEqual(member.read(), name[:8].encode())
+
+    def test_extract_everything(self):
+        self.assertEqual(archiver.extract(self.compacted, "/tmp/extract"), [
+                         f"tmp/directory/{date}/file" for date in ["20200101", "20200102", "20200103"]])
+        self.assertTrue(all([os.path.exists(f"/tmp/extract/tmp/directory/{date}/file")
+                        for date in ["20200101", "20200102", "20200103"]]))
+
+    def test_extract_members_from_their_sources(self):
+        self.assertEqual(archiver.extract(self.compacted, "/tmp/extract", ["tmp/directory/20200102/file"]),
+                         ["tmp/directory/20200102/file"])
+        self.assertEqual(os.listdir("/tmp/extract/tmp/directory"), ["20200102"])
+
+    def test_nothing_to_compact(self):
+        self.assertIsNone(archiver.compact(
+            "documents", "20200201", "20200228", "/tmp/archive", "/tmp/archive"))
+
+    def test_invalid_dates_rejected(self):
+        for start, end in [("2020011", "20200131"), ("20200101", "20201301"), ("2020-01-01", "20200131")]:
+            with self.assertRaises(ValueError):
+                archiver.compact("documents", start, end, "/tmp/archive", "/tmp/archive")
+
+
+class TestSharePolicy(TestArchiver):
+    def setUp(self) -> None:
+        super().setUp()
+
+        with open("/tmp/archive/shares.toml", "w") as f:
+            f.write('''
+[defaults]
+codec = "xz"
+level = 3
+
+[[share]]
+directory = "/filestore/Teams/Audio Resources"
+location = "Teams/Audio Resources"
+ttl = 365
+level = 1
+workers = 4
+volume_size = 1073741824
+
+[[share]]
+directory = "/filestore/Shows"
+location = "Shows"
+ttl = -1
+mode = "unit"
+dedup = true
+''')
+
+        with open("/tmp/archive/shares.yaml", "w") as f:
+            f.write('''
+share:
+  - directory: /filestore/Teams/Music
+    location: Teams/Music
+    ttl: 365
+    codec: bz2
+''')
+
+    @unittest.skipUnless(HAS_TOML, "needs Python 3.11 or tomli")
+    def test_toml_shares(self):
+        shares = policy.load_shares("/tmp/archive/shares.toml")
+        self.assertEqual(shares, [
+            policy.Share("/filestore/Teams/Audio Resources", "Teams/Audio Resources", 365, False,
+                         policy.SharePolicy(codec="xz", level=1, workers=4, volume_size=1073741824)),
+            policy.Share("/filestore/Shows", "Shows", -1, True,
+                         policy.SharePolicy(codec="xz", level=3, dedup=True))
+        ])
+
+    @unittest.skipUnless(HAS_YAML, "needs PyYAML")
+    def test_yaml_shares(self):
+        self.assertEqual(policy.load_shares("/tmp/archive/shares.yaml"), [
+            policy.Share("/filestore/Teams/Music", "Teams/Music", 365, False,
+                         policy.SharePolicy(codec="bz2"))
+        ])
+
+    def test_invalid_policies_rejected(self):
+        for settings in [{"codec": "zip"}, {"level": 10}, {"codec": "bz2", "level": 0}, {"workers": 0},
+                         {"throttle": -1}, {"dedup": "yes"}, {"scan": "sometimes"}]:
+            with self.assertRaises(ValueError):
+                policy.SharePolicy(**settings)
+
+    @unittest.skipUnless(HAS_TOML, "needs Python 3.11 or tomli")
+    def test_invalid_shares_rejected(self):
+        for share in ['directory = "/a"\nlocation = "a"',
+                      'directory = "a"\nlocation = "a"\nttl = 1',
+                      'directory = "/a"\nlocation = "/a"\nttl = 1',
+                      'directory = "/a"\nlocation = "a"\nttl = 1\nmode = "both"',
+                      'directory = "/a"\nlocation = "a"\nttl = 1\ncompression = "gz"']:
+            with open("/tmp/archive/invalid.toml", "w") as f:
+                f.write(f"[[share]]\n{share}\n")
+            with self.assertRaises(ValueError):
+                policy.load_shares("/tmp/archive/invalid.toml")
+
+    @unittest.skipUnless(HAS_TOML, "needs Python 3.11 or tomli")
+    def test_malformed_sections_rejected(self):
+        for contents in ['share = 5', 'defaults = 5', 'share = ["abc"]']:
+            with open("/tmp/archive/invalid.toml", "w") as f:
+                f.write(f"{contents}\n")
+            with self.assertRaisesRegex(ValueError, "^/tmp/archive/invalid.toml"):
+                policy.load_shares("/tmp/archive/invalid.toml")
+
+    @unittest.skipUnless(HAS_TOML, "needs Python 3.11 or tomli")
+    def test_duplicate_shares_rejected(self):
+        for second in ['directory = "/a"\nlocation = "b"\nttl = 1',
+                       'directory = "/b"\nlocation = "a/b"\nttl = 1',
+                       'directory = "/b"\nlocation = "a-b"\nttl = 1']:
+            with open("/tmp/archive/invalid.toml", "w") as f:
+                f.write(f'[[share]]\ndirectory = "/a"\nlocation = "a/b"\nttl = 1\n[[share]]\n{second}\n')
+            with self.assertRaises(ValueError):
+                policy.load_shares("/tmp/archive/invalid.toml")
+
+    @unittest.skipUnless(HAS_YAML, "needs PyYAML")
+    def test_malformed_yaml_rejected(self):
+        with open("/tmp/archive/invalid.yaml", "w") as f:
+            f.write("share: [\n")
+        with self.assertRaises(ValueError):
+            policy.load_shares("/tmp/archive/invalid.yaml")
+
+    def test_config_shares(self):
+        shares = policy.configured_shares()
+        self.assertIn(policy.Share("/filestore/Shows", "Shows", -1, True), shares)
+        self.assertIn(policy.Share("/filestore/Teams/Music", "Teams/Music", 365), shares)
+
+
+class TestArchivePolicy(TestArchiver):
+    def setUp(self) -> None:
+        super().setUp()
+
+        os.mkdir("/tmp/archive/documents")
+        for name in ["a", "b", "c", "d"]:
+            with open(f"/tmp/directory/{name}", "w") as f:
+                f.write("duplicate" if name in ["a", "b"] else name * 4096)
+            os.utime(f"/tmp/directory/{name}", times=(0, 0))
+
+        self.date = datetime.datetime.now().strftime('%Y%m%d')
+
+    def test_codec(self):
+        archiver.archive_full("/tmp/directory", "documents", 5, False, "/tmp/archive", "/tmp/archive",
+                              "/.archiveignore", policy.SharePolicy(codec="bz2", level=1))
+        with tarfile.open(f"/tmp/archive/documents/{self.date}.tar.bz2", "r:bz2") as tar:
+            self.assertEqual(sorted(tar.getnames()), [
+                             "tmp/directory/a", "tmp/directory/b", "tmp/directory/c", "tmp/directory/d"])
+
+    def test_volumes(self):
+        archiver.archive_full("/tmp/directory", "documents", 5, False, "/tmp/archive", "/tmp/archive",
+                              "/.archiveignore", policy.SharePolicy(volume_size=1))
+        names: T.List[str] = []
+        for volume in [f"{self.date}.tar.gz", *[f"{self.date}.{i}.tar.gz" for i in range(2, 5)]]:
+            with tarfile.open(f"/tmp/archive/documents/{volume}") as tar:
+                names.extend(tar.getnames())
+        self.assertEqual(sorted(names), [
+                         "tmp/directory/a", "tmp/directory/b", "tmp/directory/c", "tmp/directory/d"])
+        self.assertFalse(os.path.exists(f"/tmp/archive/documents/{self.date}.5.tar.gz"))
+
+    def test_dedup(self):
+        archiver.archive_full("/tmp/directory", "documents", 5, False, "/tmp/archive", "/tmp/archive",
+                              "/.archiveignore", policy.SharePolicy(dedup=True, workers=2))
+        with tarfile.open(f"/tmp/archive/documents/{self.date}.tar.gz") as tar:
+            links = [member for member in tar.getmembers() if member.islnk()]
+            self.assertEqual(len(links), 1)
+            tar.extractall("/tmp/extract")
+
+        for name in ["a", "b"]:
+            with open(f"/tmp/extract/tmp/directory/{name}") as f:
+                self.assertEqual(f.read(), "duplicate")
+
+    def test_dedup_file_changed_after_hashing(self):
+        duplicates = archiver._duplicates
+
+        def change_b(*args: T.Any) -> T.Any:
+            hashed = duplicates(*args)
+            with open("/tmp/directory/b", "w") as f:
+                f.write("different")
+            os.utime("/tmp/directory/b", times=(1, 1))
+            return hashed
+
+        with unittest.mock.patch("archiver._duplicates", side_effect=change_b):
+            archiver.archive_full("/tmp/directory", "documents", 5, False, "/tmp/archive", "/tmp/archive",
+                                  "/.archiveignore", policy.SharePolicy(dedup=True))
+        with tarfile.open(f"/tmp/archive/documents/{self.date}.tar.gz") as tar:
+            self.assertFalse(any([member.islnk() for member in tar.getmembers()]))
+            tar.extractall("/tmp/extract")
+
+        for name, contents in [("a", "duplicate"), ("b", "different")]:
+            with open(f"/tmp/extract/tmp/directory/{name}") as f:
+                self.assertEqual(f.read(), contents)
+
+
+class TestFullArchiverPlan(TestFullArchiver):
+    def test_plan_matches_archive(self):
+        self.assertEqual(set(archiver.plan_full("/tmp/directory", 5, "/.archiveignore")),
+                         set(super().to_archive))
+
+    def test_plan_leaves_everything(self):
+        archiver.plan_full("/tmp/directory", 5, "/.archiveignore")
+        self.assertEqual(os.listdir("/tmp/archive/documents"), [])
+        self.assertTrue(all([os.path.exists(item)
+                        for item in [*super().to_archive, *super().to_keep, *super().to_ignore]]))
+
+
+class TestUnitArchiverPlan(TestUnitArchiver):
+    def test_plan_matches_archive(self):
+        subdirectories, files = archiver.plan_unit(
+            "/tmp/directory", 5, "/.archiveignore")
+        self.assertEqual(subdirectories, ["/tmp/directory/old"])
+        self.assertEqual(sorted(files), [
+                         "/tmp/directory/file_a", "/tmp/directory/file_b"])
+
+    def test_missing_directory(self):
+        self.assertEqual(archiver.plan_unit(
+            "/tmp/directory/missing", 5, "/.archiveignore"), ([], []))
+
+
+class TestStartup(TestFullArchiver):
+    # Quick invocations such as `plan` shouldn't pay for imports they don't use, or for the safety delay
+    IMPORT_BUDGET = 0.25
+    RUN_BUDGET = 1.5
+
+    def run_archiver(self, *args: str) -> T.Tuple[float, str]:
+        """Run the archiver as a script, archiving /tmp/directory rather than the configured shares"""
+
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", "\n".join([
+            "import sys, config",
+            "config.SHARES_FILE = None",
+            "config.ARCHIVE_DIRS = {'/tmp/directory': ('documents', 5)}",
+            "config.ARCHIVE_UNITS = {}",
+            "import archiver",
+            "sys.exit(archiver.cli(sys.argv[1:]))"
+        ]), *args], cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True, capture_output=True, text=True)
+        return time.perf_counter() - start, result.stdout
+
+    def test_import_is_lazy(self):
+        result = subprocess.run([sys.executable, "-c", "\n".join([
+            "import sys, time",
+            "start = time.perf_counter()",
+            "import archiver",
+            "print(time.perf_counter() - start)",
+            "print(' '.join(m for m in ['tarfile', 'shutil', 'hashlib', 'concurrent.futures'] if m in sys.modules))"
+        ])], cwd=os.path.dirname(os.path.abspath(__file__)), check=True, capture_output=True, text=True)
+        duration, loaded = result.stdout.split("\n")[:2]
+
+        self.assertEqual(loaded, "")
+        self.assertLess(float(duration), self.IMPORT_BUDGET)
+
+    def test_help_within_budget(self):
+        self.assertLess(self.run_archiver("--help")[0], self.RUN_BUDGET)
+
+    def test_plan_within_budget(self):
+        duration, planned = self.run_archiver("plan")
+        self.assertEqual(set(planned.splitlines()), set(super().to_archive))
+        self.assertLess(duration, self.RUN_BUDGET)
+
+    def test_extract_ignores_share_definitions(self):
+        with tarfile.open("/tmp/archive/archive.tar.gz", "w:gz") as tar:
+            tar.add("/tmp/directory/old_file")
+
+        with unittest.mock.patch.object(config, "SHARES_FILE", "/tmp/archive/missing.toml"):
+            self.assertEqual(archiver.cli(["extract", "/tmp/archive/archive.tar.gz", "/tmp/extract"]), 0)
+        self.assertTrue(os.path.exists("/tmp/extract/tmp/directory/old_file"))
+
+    def test_profile_rejected_when_not_archiving(self):
+        for command in [["plan"], ["compact", "20200101", "20200131"], ["scrub"]]:
+            with self.assertRaises(SystemExit), unittest.mock.patch("sys.stderr", io.StringIO()):
+                archiver.cli(["--profile", "/tmp/archive/profile", *command])
+
+    def test_compact_waits_before_deleting(self):
+        with unittest.mock.patch("time.sleep") as sleep, unittest.mock.patch("archiver.compact_all") as compact_all:
+            archiver.cli(["compact", "20200101", "20200131"])
+        sleep.assert_called_once_with(config.SAFETY_DELAY)
+        compact_all.assert_called_once()
+
+
+class TestFullArchiverProfiled(TestFullArchiver):
+    def setUp(self) -> None:
+        super().setUp()
+
+        with self.assertLogs(level="INFO") as logs:
+            with profiling.profile("/tmp/archive/profile", "documents", 5):
+                archiver.archive_full("/tmp/directory", "documents",
+                                      5, True, "/tmp/archive", "/tmp/archive", "/.archiveignore")
+        self.summary = logs.output[-1]
+
+    def test_profile_written(self):
+        stats = pstats.Stats("/tmp/archive/profile.documents.pstats")
+        self.assertTrue(any([function == "archive_full" for _, _, function in stats.stats]))
+
+    def test_stages_in_summary(self):
+        self.assertTrue(all([f"{stage}: " in self.summary for stage in [
+                        "walk", "ignore", "tar", "delete"]]))
+
+    def test_hotspots_in_summary(self):
+        self.assertIn("archive_full", self.summary)
+
+    def test_stages_not_timed_afterwards(self):
+        self.assertIsNone(profiling._active)
+
+
+class TestPathTree(TestFullArchiver):
+    def setUp(self) -> None:
+        super().setUp()
+
+        os.symlink("/tmp/directory/subdir_archive",
+                   "/tmp/directory/subdir_dont_touch/link")
+        self.tree = PathTree.scan("/tmp/directory")
+
+    def test_same_entries_as_all_entries(self):
+        self.assertEqual([path for _, path in self.tree.paths()],
+                         archiver.all_entries("/tmp/directory"))
+
+    def test_path(self):
+        self.assertEqual([self.tree.path(node) for node in range(len(self.tree))],
+                         archiver.all_entries("/tmp/directory"))
+
+    def test_mtimes(self):
+        self.assertTrue(all([self.tree.mtimes[node] == os.stat(path).st_mtime
+                        for node, path in self.tree.paths()]))
+
+    def test_find(self):
+        self.assertEqual(self.tree.find("/tmp/directory"), -1)
+        for node, path in self.tree.paths():
+            self.assertEqual(self.tree.find(path), node)
+        for path in ["/tmp/directory/", "/tmp/directory/missing", "/tmp/directory//subdir_ignore",
+                     "/tmp/directory/subdir_ignore/./subdir", "/tmp/directory/old_file/child", "/tmp/other"]:
+            self.assertIsNone(self.tree.find(path))
+
+    def test_descendants(self):
+        node = self.tree.find("/tmp/directory/subdir_ignore")
+        self.assertEqual(sorted([self.tree.path(child) for child in self.tree.descendants(node)]), [
+            "/tmp/directory/subdir_ignore/.archiveignore",
+            "/tmp/directory/subdir_ignore/archive",
+            "/tmp/directory/subdir_ignore/parent_ignore",
+            "/tmp/directory/subdir_ignore/subdir",
+            "/tmp/directory/subdir_ignore/subdir/file",
+            "/tmp/directory/subdir_ignore/subdir_ignore"
+        ])
+
+    def test_symlinks_not_followed(self):
+        node = self.tree.find("/tmp/directory/subdir_dont_touch/link")
+        self.assertTrue(self.tree.is_dir[node])
+        self.assertEqual(list(self.tree.descendants(node)), [])
+
+    def test_names_not_repeated(self):
+        self.assertTrue(all(["/" not in name for name in self.tree.names]))
+
+
+class TestFullArchiverIgnorePatterns(TestFullArchiver):
+    def test_wildcards(self):
+        with open("/tmp/directory/subdir_archive/.archiveignore", "w") as f:
+            f.write("*_1\n")
+        os.utime("/tmp/directory/subdir_archive", times=(0, 0))
+
+        self.assertEqual(set(archiver.plan_full("/tmp/directory", 5, "/.archiveignore")),
+                         set(super().to_archive) - {"/tmp/directory/subdir_archive/old_file_1"})
+
+    def test_blank_line_ignores_everything_below(self):
+        with open("/tmp/directory/subdir_archive/.archiveignore", "w") as f:
+            f.write("\n")
+        os.utime("/tmp/directory/subdir_archive", times=(0, 0))
+
+        self.assertEqual(set(archiver.plan_full("/tmp/directory", 5, "/.archiveignore")),
+                         set(super().to_archive) - {"/tmp/directory/subdir_archive/old_file_1",
+                                                    "/tmp/directory/subdir_archive/old_file_2"})
+
+
+class TestShareLock(TestArchiver):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.lock = locking.ShareLock("/tmp/archive/locks", "documents", 60)
+
+    def tearDown(self) -> None:
+        self.lock.release()
+        super().tearDown()
+
+    def test_acquire_and_release(self):
+        self.assertTrue(self.lock.acquire())
+        self.assertEqual(self.lock.held_by(), self.lock.holder)
+
+        self.lock.release()
+        self.assertIsNone(self.lock.held_by())
+        self.assertTrue(locking.ShareLock(
+            "/tmp/archive/locks", "documents", 60).acquire())
+
+    def test_other_process_cant_acquire(self):
+        self.assertTrue(self.lock.acquire())
+        # Reading the lease mustn't drop the fcntl lock
+        self.assertEqual(self.lock.held_by(), self.lock.holder)
+
+        result = subprocess.run([sys.executable, "-c", "\n".join([
+            "import locking",
+            "print(locking.ShareLock('/tmp/archive/locks', 'documents', 60).acquire())"
+        ])], cwd=os.path.dirname(os.path.abspath(__file__)), check=True, capture_output=True, text=True)
+        self.assertEqual(result.stdout.strip(), "False")
+
+    def test_live_lease_respected(self):
+        # As if another host holds the lock on a mount which doesn't pass fcntl locks on
+        os.mkdir("/tmp/archive/locks")
+        with open("/tmp/archive/locks/documents.lease", "w") as f:
+            f.write(f"otherhost 1 abc {time.time()}\n")
+
+        self.assertFalse(self.lock.acquire())
+
+    def test_expired_lease_taken_over(self):
+        os.mkdir("/tmp/archive/locks")
+        with open("/tmp/archive/locks/documents.lease", "w") as f:
+            f.write(f"otherhost 1 abc {time.time() - 61}\n")
+
+        self.assertTrue(self.lock.acquire())
+        self.assertEqual(self.lock.held_by(), self.lock.holder)
+        self.assertEqual(sorted(os.listdir("/tmp/archive/locks")), ["documents.lease", "documents.lock"])
+
+    def test_lease_taken_while_settling(self):
+        # As if another host wrote its lease just after this one did
+        def other_host(_: float) -> None:
+            with open("/tmp/archive/locks/documents.lease", "w") as f:
+                f.write(f"otherhost 1 abc {time.time()}\n")
+
+        self.lock = locking.ShareLock("/tmp/archive/locks", "documents", 60, settle=1)
+        with unittest.mock.patch("time.sleep", side_effect=other_host):
+            self.assertFalse(self.lock.acquire())
+        self.assertEqual(self.lock.held_by(), "otherhost 1 abc")
+
+    def test_lease_renewed(self):
+        self.lock = locking.ShareLock("/tmp/archive/locks", "documents", 0.3)
+        self.assertTrue(self.lock.acquire())
+        time.sleep(0.5)
+        self.assertEqual(self.lock.held_by(), self.lock.holder)
+
+    def test_locked_share_skipped(self):
+        os.mkdir("/tmp/archive/documents")
+        with open("/tmp/directory/old_file", "w"):
+            pass
+        os.utime("/tmp/directory/old_file", times=(0, 0))
+
+        os.mkdir("/tmp/archive/locks")
+        with open("/tmp/archive/locks/documents.lease", "w") as f:
+            f.write(f"otherhost 1 abc {time.time()}\n")
+
+        with unittest.mock.patch.multiple(config, LOCK_DIR="/tmp/archive/locks", LOCK_SETTLE=0,
+                                          ARCHIVE_LOC="/tmp/archive", LIBRARY_LOC="/tmp/archive"):
+            archiver.main(shares=[policy.Share("/tmp/directory", "documents", 5)])
+        self.assertEqual(os.listdir("/tmp/archive/documents"), [])
+
+        os.remove("/tmp/archive/locks/documents.lease")
+        with unittest.mock.patch.multiple(config, LOCK_DIR="/tmp/archive/locks", LOCK_SETTLE=0,
+                                          ARCHIVE_LOC="/tmp/archive", LIBRARY_LOC="/tmp/archive"):
+            archiver.main(shares=[policy.Share("/tmp/directory", "documents", 5)])
+        self.assertNotEqual(os.listdir("/tmp/archive/documents"), [])
+
+    def test_finished_share_skipped(self):
+        os.mkdir("/tmp/archive/documents")
+        with open("/tmp/directory/old_file", "w"):
+            pass
+        os.utime("/tmp/directory/old_file", times=(0, 0))
+
+        with unittest.mock.patch.multiple(config, LOCK_DIR="/tmp/archive/locks", LOCK_SETTLE=0,
+                                          ARCHIVE_LOC="/tmp/archive", LIBRARY_LOC="/tmp/archive"):
+            with unittest.mock.patch("archiver.archive_full") as archive_full:
+                archiver.main(shares=[policy.Share("/tmp/directory", "documents", 5)])
+                archiver.main(shares=[policy.Share("/tmp/directory", "documents", 5)])
+            self.assertEqual(archive_full.call_count, 1)
+
+            # Having only archived, the files still need deleting
+            archiver.main(weaponised=True, shares=[policy.Share("/tmp/directory", "documents", 5)])
+            self.assertFalse(os.path.exists("/tmp/directory/old_file"))
+
+            with unittest.mock.patch("archiver.archive_full") as archive_full:
+                archiver.main(shares=[policy.Share("/tmp/directory", "documents", 5)])
+            archive_full.assert_not_called()
+
+
+class TestScrub(TestUnitArchiver):
+    def setUp(self) -> None:
+        super().setUp()
+
+        archiver.archive_unit("/tmp/directory", "units", 5, False,
+                              "/tmp/archive", "/tmp/archive", "/.archiveignore")
+        self.date = datetime.datetime.now().strftime('%Y%m%d')
+
+    def scrub(self, **kwargs: T.Any) -> bool:
+        return scrub.scrub("/tmp/archive", "/tmp/archive", "/tmp/archive/scrub.json", **{
+            "interval": 90, "workers": 2, "rate": 0, **kwargs})
+
+    def state(self) -> T.Dict[str, T.Any]:
+        with open("/tmp/archive/scrub.json") as f:
+            return json.load(f)
+
+    def test_find_archives(self):
+        self.assertEqual(scrub.find_archives("/tmp/archive", "/tmp/archive"), [
+            ([f"/tmp/archive/units/{self.date}.tar.gz"],
+             f"/tmp/archive/units/{self.date}.fofn"),
+            ([f"/tmp/archive/units/old.{self.date}.tar.gz"],
+             f"/tmp/archive/units/old.{self.date}.fofn")
+        ])
+
+    def test_healthy_archives_pass(self):
+        self.assertTrue(self.scrub())
+        self.assertTrue(all([entry["ok"] for entry in self.state().values()]))
+        self.assertEqual(len(self.state()), 2)
+
+    def test_verified_archives_not_rechecked(self):
+        self.assertTrue(self.scrub())
+        verified = {archive: entry["verified"] for archive, entry in self.state().items()}
+
+        self.assertTrue(self.scrub())
+        self.assertEqual({archive: entry["verified"] for archive, entry in self.state().items()}, verified)
+
+        self.assertTrue(self.scrub(interval=0))
+        self.assertTrue(all([self.state()[archive]["verified"] > verified[archive] for archive in verified]))
+
+    def test_limit_resumes(self):
+        self.assertTrue(self.scrub(limit=1))
+        self.assertEqual(len(self.state()), 1)
+
+        self.assertTrue(self.scrub(limit=1))
+        self.assertEqual(len(self.state()), 2)
+
+    def test_corrupt_archive_fails(self):
+        with open(f"/tmp/archive/units/old.{self.date}.tar.gz", "r+b") as f:
+            f.seek(-12, os.SEEK_END)
+            f.write(b"\0" * 8)
+
+        self.assertFalse(self.scrub())
+        self.assertFalse(self.state()[f"/tmp/archive/units/old.{self.date}.tar.gz"]["ok"])
+        self.assertTrue(self.state()[f"/tmp/archive/units/{self.date}.tar.gz"]["ok"])
+
+    def test_checksum_mismatch_fails(self):
+        with open(f"/tmp/archive/units/{self.date}.tar.gz.sha256", "w") as f:
+            f.write(f"{'0' * 64}  {self.date}.tar.gz\n")
+
+        self.assertEqual(scrub.verify([f"/tmp/archive/units/{self.date}.tar.gz"], f"/tmp/archive/units/{self.date}.fofn"),
+                         [f"/tmp/archive/units/{self.date}.tar.gz doesn't match its recorded checksum"])
+
+    def test_missing_from_archive_fails(self):
+        with open(f"/tmp/archive/units/old.{self.date}.fofn", "a") as f:
+            f.write("\n/tmp/directory/old/file_c")
+
+        self.assertEqual(scrub.verify([f"/tmp/archive/units/old.{self.date}.tar.gz"], f"/tmp/archive/units/old.{self.date}.fofn"),
+                         [f"/tmp/directory/old/file_c is in /tmp/archive/units/old.{self.date}.fofn but not in /tmp/archive/units/old.{self.date}.tar.gz"])
+
+    def test_entries_matched_exactly(self):
+        # Only the trailing part of this path is in the archive
+        with open(f"/tmp/archive/units/{self.date}.fofn", "a") as f:
+            f.write("\n/elsewhere/tmp/directory/file_a")
+
+        self.assertEqual(scrub.verify([f"/tmp/archive/units/{self.date}.tar.gz"], f"/tmp/archive/units/{self.date}.fofn"),
+                         [f"/elsewhere/tmp/directory/file_a is in /tmp/archive/units/{self.date}.fofn but not in /tmp/archive/units/{self.date}.tar.gz"])
+
+    def test_unit_archive_of_nested_directories(self):
+        os.makedirs("/tmp/directory/deep/deep/deep")
+        with open("/tmp/directory/deep/deep/deep/file", "w"):
+            pass
+        for path in ["/tmp/directory/deep/deep/deep/file", "/tmp/directory/deep/deep/deep",
+                     "/tmp/directory/deep/deep", "/tmp/directory/deep"]:
+            os.utime(path, times=(0, 0))
+        archiver.archive_unit("/tmp/directory", "units", 5, False,
+                              "/tmp/archive", "/tmp/archive", "/.archiveignore")
+
+        self.assertEqual(scrub.verify([f"/tmp/archive/units/deep.{self.date}.tar.gz"],
+                                      f"/tmp/archive/units/deep.{self.date}.fofn"), [])
+
+    def test_corrupt_xz_archive_fails(self):
+        os.mkdir("/tmp/archive/xz")
+        with open("/tmp/directory/old/file_b", "w") as f:
+            f.write("".join([str(i) for i in range(100000)]))
+        os.utime("/tmp/directory/old", times=(0, 0))
+        archiver.archive_unit("/tmp/directory", "xz", 5, False, "/tmp/archive", "/tmp/archive",
+                              "/.archiveignore", policy.SharePolicy(codec="xz"))
+        with open(f"/tmp/archive/xz/old.{self.date}.tar.xz", "r+b") as f:
+            # Past the first header, so tarfile has started reading the compressed data
+            f.seek(os.path.getsize(f.name) // 2)
+            f.write(b"\xff" * 64)
+
+        problems = scrub.verify([f"/tmp/archive/xz/old.{self.date}.tar.xz"], f"/tmp/archive/xz/old.{self.date}.fofn")
+        self.assertTrue(any([problem.startswith(f"/tmp/archive/xz/old.{self.date}.tar.xz can't be read")
+                             for problem in problems]))
+
+    def test_unfinished_archive_skipped(self):
+        os.remove(f"/tmp/archive/units/old.{self.date}.tar.gz.sha256")
+
+        self.assertTrue(self.scrub())
+        self.assertNotIn(f"/tmp/archive/units/old.{self.date}.tar.gz", self.state())
+
+        # Without a checksum, but untouched for long enough to have been finished
+        os.utime(f"/tmp/archive/units/old.{self.date}.tar.gz", times=(0, 0))
+        self.assertTrue(self.scrub())
+        self.assertIn(f"/tmp/archive/units/old.{self.date}.tar.gz", self.state())
+
+    def test_checksum_recorded_after_fofn(self):
+        # The checksum marks an archive as finished, so scrub can tell it's safe to read
+        record_checksum = archiver._record_checksum
+
+        def check_fofn(tarball: T.Any) -> None:
+            fofn = scrub.find_archives("/tmp/archive", "/tmp/archive")
+            self.assertTrue(all([os.path.exists(f) for archives, f in fofn if tarball.name in archives]))
+            record_checksum(tarball)
+
+        os.mkdir("/tmp/archive/documents")
+        with unittest.mock.patch("archiver._record_checksum", side_effect=check_fofn) as recorded:
+            archiver.archive_unit("/tmp/directory", "units", 5, False,
+                                  "/tmp/archive", "/tmp/archive", "/.archiveignore")
+            archiver.archive_full("/tmp/directory", "documents", -1, False, "/tmp/archive", "/tmp/archive",
+                                  "/.archiveignore", policy.SharePolicy(volume_size=1))
+        self.assertGreater(recorded.call_count, 3)
+        self.assertTrue(self.scrub())
+
+    def test_unreadable_fofn_fails(self):
+        fofn = f"/tmp/archive/units/old.{self.date}.fofn"
+        real_open = open
+
+        def denied(path: T.Any, *args: T.Any, **kwargs: T.Any) -> T.Any:
+            if path == fofn:
+                raise PermissionError(13, "Permission denied", path)
+            return real_open(path, *args, **kwargs)
+
+        with unittest.mock.patch("builtins.open", side_effect=denied):
+            self.assertEqual(scrub.verify([f"/tmp/archive/units/old.{self.date}.tar.gz"], fofn),
+                             [f"{fofn} can't be read: [Errno 13] Permission denied: '{fofn}'"])
+
+    def test_state_saved_in_batches(self):
+        with unittest.mock.patch("scrub._save_state") as save_state:
+            self.assertTrue(self.scrub(save_interval=3600))
+        save_state.assert_called_once()
+        self.assertEqual(len(save_state.call_args[0][1]), 2)
+
+    def test_vanished_archive_skipped(self):
+        self.assertIsNone(scrub.verify(
+            ["/tmp/archive/units/missing.tar.gz"], "/tmp/archive/units/missing.fofn"))
+
+    def test_compacted_archive(self):
+        os.rename(f"/tmp/archive/units/{self.date}.tar.gz", "/tmp/archive/units/20200101.tar.gz")
+        os.rename(f"/tmp/archive/units/{self.date}.tar.gz.sha256", "/tmp/archive/units/20200101.tar.gz.sha256")
+        os.rename(f"/tmp/archive/units/{self.date}.fofn", "/tmp/archive/units/20200101.fofn")
+        archiver.archive_unit("/tmp/directory", "units", 5, False,
+                              "/tmp/archive", "/tmp/archive", "/.archiveignore")
+        archiver.compact("units", "20200101", self.date, "/tmp/archive", "/tmp/archive")
+
+        self.assertEqual(scrub.verify([f"/tmp/archive/units/20200101-{self.date}.multi.tar.gz"],
+                                      f"/tmp/archive/units/20200101-{self.date}.multi.fofn"), [])
+
+
 if __name__ == "__main__":
     unittest.main()
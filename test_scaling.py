@@ -0,0 +1,159 @@
+import unittest
+import archiver
+import datetime
+import os
+import shutil
+import time
+import tracemalloc
+import typing as T
+
+# These build trees of up to 100,000 entries, so only run when asked to:
+#   VASHTA_SCALING=1 python -m unittest test_scaling -v
+SCALING = os.environ.get("VASHTA_SCALING") == "1"
+
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5]
+# Writing tarballs, fofns and checksums is much slower than planning, so is only measured at the smaller sizes
+WRITE_SIZES = SIZES[:2]
+# Entries per directory, each of which has its own .archiveignore
+FANOUT = 100
+# How much worse the cost per entry may get for each tenfold increase in entries. Linear code stays
+# close to 1, while anything quadratic is around 10
+TIME_GROWTH = 3.0
+MEMORY_GROWTH = 2.0
+DATE = datetime.datetime.now().strftime("%Y%m%d")
+# Peak bytes allocated per entry while planning, and while writing (which keeps every tarball member in memory)
+MEMORY_BUDGET = 1024
+WRITE_MEMORY_BUDGET = 4096
+
+
+def build_full(root: str, size: int) -> None:
+    """Directories of FANOUT files, every directory having an .archiveignore with literal and wildcard entries"""
+
+    os.mkdir(root)
+    for d in range(size // FANOUT):
+        directory = os.path.join(root, f"group {d // FANOUT:04d}", f"directory {d:06d}")
+        os.makedirs(directory)
+        for f in range(FANOUT - 2):
+            open(os.path.join(directory, f"file_{f:03d}.wav"), "w").close()
+        with open(os.path.join(directory, ".archiveignore"), "w") as ignorefile:
+            ignorefile.write("file_000.wav\nfile_01?.wav\n*_02[0-4].wav\n")
+
+    with open(os.path.join(root, ".archiveignore"), "w") as ignorefile:
+        ignorefile.write("group 0000/directory 000000\n*/file_097.wav\n")
+
+
+def build_unit(root: str, size: int) -> None:
+    """Directories, with a root .archiveignore naming one in every ten of them"""
+
+    os.mkdir(root)
+    with open(os.path.join(root, ".archiveignore"), "w") as ignorefile:
+        for d in range(size):
+            os.mkdir(os.path.join(root, f"unit {d:06d}"))
+            if d % 10 == 0:
+                ignorefile.write(f"unit {d:06d}\n")
+        ignorefile.write("unit 00001?\n")
+
+
+@unittest.skipUnless(SCALING, "set VASHTA_SCALING=1 to run the scaling tests")
+class TestScaling(unittest.TestCase):
+    # Trees are planned with a ttl of -1, so that everything is old enough to be checked against the
+    # ignore files without having to age every file
+    builder: T.Callable[[str, int], None]
+    planner: T.Callable[[str], T.Any]
+    # Archives a tree into the output directory without deleting anything
+    writer: T.Callable[[str, str], None]
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        try:
+            shutil.rmtree("/tmp/scaling")
+        except FileNotFoundError:
+            pass
+        os.mkdir("/tmp/scaling")
+
+        for size in SIZES:
+            cls.builder(f"/tmp/scaling/{size}", size)
+        os.mkdir("/tmp/scaling/archive")
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        shutil.rmtree("/tmp/scaling")
+
+    def write(self, directory: str) -> None:
+        """Archive a tree into a fresh output directory"""
+
+        try:
+            shutil.rmtree("/tmp/scaling/archive/output")
+        except FileNotFoundError:
+            pass
+        os.mkdir("/tmp/scaling/archive/output")
+        self.writer(directory, "output")
+
+    def measure(self, operation: T.Callable[[str], T.Any], size: int) -> T.Tuple[float, float]:
+        """Best time, and peak allocation, per entry"""
+
+        times = []
+        for _ in range(2):
+            start = time.perf_counter()
+            operation(f"/tmp/scaling/{size}")
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        operation(f"/tmp/scaling/{size}")
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return min(times) / size, peak / size
+
+    def check_scaling(self, operation: T.Callable[[str], T.Any], sizes: T.List[int], memory_budget: int) -> None:
+        costs = [self.measure(operation, size) for size in sizes]
+
+        for (smaller_time, smaller_memory), (larger_time, larger_memory), size in zip(costs, costs[1:], sizes[1:]):
+            with self.subTest(size=size):
+                self.assertLess(larger_time / smaller_time, TIME_GROWTH)
+                self.assertLess(larger_memory / smaller_memory, MEMORY_GROWTH)
+                self.assertLess(larger_memory, memory_budget)
+
+
+class TestFullArchiverScaling(TestScaling):
+    builder = staticmethod(build_full)
+    planner = staticmethod(lambda directory: archiver.plan_full(directory, -1, "/.archiveignore"))
+    writer = staticmethod(lambda directory, location: archiver.archive_full(
+        directory, location, -1, False, "/tmp/scaling/archive", "/tmp/scaling/archive", "/.archiveignore"))
+
+    def test_plan_is_linear(self):
+        # The group directory, every directory but the ignored first one, and all but 17 ignored files in each
+        self.assertEqual(len(self.planner("/tmp/scaling/1000")), 1 + (1000 // FANOUT - 1) * (1 + FANOUT - 2 - 17))
+        self.check_scaling(self.planner, SIZES, MEMORY_BUDGET)
+
+    def test_write_is_linear(self):
+        self.write("/tmp/scaling/1000")
+        self.assertEqual(sorted(os.listdir("/tmp/scaling/archive/output")),
+                         sorted([f"{DATE}.tar.gz", f"{DATE}.tar.gz.sha256", f"{DATE}.fofn"]))
+        self.check_scaling(self.write, WRITE_SIZES, WRITE_MEMORY_BUDGET)
+
+
+class TestUnitArchiverScaling(TestScaling):
+    builder = staticmethod(build_unit)
+    planner = staticmethod(lambda directory: archiver.plan_unit(directory, -1, "/.archiveignore"))
+    writer = staticmethod(lambda directory, location: archiver.archive_unit(
+        directory, location, -1, False, "/tmp/scaling/archive", "/tmp/scaling/archive", "/.archiveignore"))
+
+    def test_plan_is_linear(self):
+        subdirectories, files = self.planner("/tmp/scaling/1000")
+        self.assertEqual(len(subdirectories), 1000 - 100 - 9)
+        self.assertEqual(files, [])
+        self.check_scaling(self.planner, SIZES, MEMORY_BUDGET)
+
+    def test_write_is_linear(self):
+        self.write("/tmp/scaling/1000")
+        # An archive, checksum and fofn for each subdirectory which isn't ignored
+        self.assertEqual(len(os.listdir("/tmp/scaling/archive/output")), 3 * (1000 - 100 - 9))
+        self.check_scaling(self.write, WRITE_SIZES, WRITE_MEMORY_BUDGET)
+
+
+del TestScaling
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+import array
+import os
+import sys
+
+import typing as T
+
+Mapper = T.Callable[[T.Callable[[os.DirEntry], float], T.List[os.DirEntry]], T.Iterable[float]]
+
+
+def _mtime(entry: "os.DirEntry[str]") -> float:
+    try:
+        return entry.stat().st_mtime
+    except FileNotFoundError:
+        # A broken symlink, so use the link itself
+        return entry.stat(follow_symlinks=False).st_mtime
+
+
+class PathTree:
+    """Everything below a directory, stored compactly
+
+    Each entry is a node, numbered in the same order as all_entries lists them. A node only stores its
+    own name, with its parent, children and metadata held in arrays, so long prefixes aren't repeated
+    for every file. Full paths are built on demand by paths() and path().
+    """
+
+    __slots__ = ("root", "root_count", "names", "parents", "first_child", "child_count", "mtimes", "is_dir", "_lookup")
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        # The children of the root come first
+        self.root_count = 0
+        self.names: T.List[str] = []
+        # Parent of each node, or -1 for the children of the root
+        self.parents = array.array("q")
+        # Children of a directory are stored together, so these give the range of them
+        self.first_child = array.array("q")
+        self.child_count = array.array("q")
+        self.mtimes = array.array("d")
+        self.is_dir = bytearray()
+        # Children by name, for the directories find() has looked in
+        self._lookup: T.Dict[int, T.Dict[str, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @classmethod
+    def scan(cls, root: str, mapper: Mapper = map) -> "PathTree":
+        """Walk a directory in the same way as os.walk, recording the modified time of each entry
+
+        :param root: - The directory to walk
+        :param mapper: - Used to stat the entries of each directory, so they can be done in parallel
+        """
+
+        tree = cls(root)
+        stack: T.List[T.Tuple[int, str]] = [(-1, root)]
+
+        while stack:
+            parent, directory = stack.pop()
+            try:
+                with os.scandir(directory) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+
+            subdirs: T.List["os.DirEntry[str]"] = []
+            files: T.List["os.DirEntry[str]"] = []
+            walk_into: T.List[bool] = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    subdirs.append(entry)
+                    try:
+                        walk_into.append(not entry.is_symlink())
+                    except OSError:
+                        walk_into.append(True)
+                else:
+                    files.append(entry)
+
+            first = len(tree.names)
+            if parent == -1:
+                tree.root_count = len(entries)
+            else:
+                tree.first_child[parent] = first
+                tree.child_count[parent] = len(entries)
+
+            for entry in [*subdirs, *files]:
+                tree.names.append(sys.intern(entry.name))
+                tree.parents.append(parent)
+                tree.first_child.append(-1)
+                tree.child_count.append(0)
+            tree.is_dir.extend([1] * len(subdirs) + [0] * len(files))
+            tree.mtimes.extend(mapper(_mtime, [*subdirs, *files]))
+
+            # Reversed so they're popped, and numbered, in the same order as os.walk visits them
+            for i in reversed(range(len(subdirs))):
+                if walk_into[i]:
+                    stack.append((first + i, subdirs[i].path))
+
+        return tree
+
+    def path(self, node: int) -> str:
+        parts: T.List[str] = []
+        while node != -1:
+            parts.append(self.names[node])
+            node = self.parents[node]
+        return os.path.join(self.root, *reversed(parts))
+
+    def paths(self) -> T.Iterator[T.Tuple[int, str]]:
+        """Every node with its full path, in order, only keeping the paths of directories"""
+
+        directories: T.Dict[int, str] = {-1: self.root}
+        for node, (name, parent) in enumerate(zip(self.names, self.parents)):
+            path = os.path.join(directories[parent], name)
+            if self.is_dir[node]:
+                directories[node] = path
+            yield node, path
+
+    def find(self, path: str) -> T.Optional[int]:
+        """The node with exactly this path, -1 for the root itself, or None if there isn't one"""
+
+        if path == self.root:
+            return -1
+
+        prefix = os.path.join(self.root, "")
+        if not path.startswith(prefix):
+            return None
+
+        node = -1
+        for name in path[len(prefix):].split("/"):
+            if node not in self._lookup:
+                self._lookup[node] = {self.names[child]: child for child in self.children(node)}
+            child = self._lookup[node].get(name)
+            if child is None:
+                return None
+            node = child
+
+        return node
+
+    def children(self, node: int) -> range:
+        if node == -1:
+            return range(0, self.root_count)
+        return range(self.first_child[node], self.first_child[node] + self.child_count[node])
+
+    def descendants(self, node: int) -> T.Iterator[int]:
+        """Every node below this one (everything, for -1)"""
+
+        if node == -1:
+            yield from range(len(self.names))
+            return
+
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for child in self.children(node):
+                yield child
+                if self.is_dir[child]:
+                    stack.append(child)